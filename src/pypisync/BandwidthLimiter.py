@@ -0,0 +1,118 @@
+import datetime
+import logging
+import re
+import threading
+import time
+
+import pypisync
+
+
+class BandwidthLimiter:
+    """
+    Global bandwidth cap of the downloads, shared by all the workers.
+
+    A token bucket of bytes, refilled at the current rate and holding at most one second of it. The rate is the one of
+    the first time-of-day window matching the local time, else the default one. A rate of 0 pauses the downloads until
+    the window ends: the files are not started, and the ones already started are finished at the default rate, as
+    their connections would time out if they were paused.
+    """
+    logger = logging.getLogger(__name__)
+
+    time_re = re.compile(r"^(?P<hours>[0-9]{1,2}):(?P<minutes>[0-9]{2})$")
+    # Delay between two looks at the windows while paused, in seconds
+    pause_interval = 10.0
+
+    def __init__(self, rate=None, windows=None):
+        """
+        :param rate: the maximum number of bytes per second, None for no limit
+        :param windows: a list of {"start": "HH:MM", "end": "HH:MM", "days": [0, ..., 6], "max_bytes_per_second": n}.
+                        "days" (0 for Monday) is optional. A window may go past midnight: "22:00" to "06:00"
+        """
+        self._rate = rate
+        self._windows = [self._parse_window(window) for window in windows or ()]
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._paused = False
+
+    @classmethod
+    def _parse_time(cls, value):
+        """
+        :return: the minutes since midnight of "HH:MM"
+        """
+        match = cls.time_re.fullmatch(value)
+        if match is None or int(match.group("hours")) > 24 or int(match.group("minutes")) > 59:
+            raise ValueError("Invalid time %r, expected HH:MM" % value)
+        return int(match.group("hours")) * 60 + int(match.group("minutes"))
+
+    @classmethod
+    def _parse_window(cls, window):
+        days = window.get("days")
+        return (
+            cls._parse_time(window["start"]),
+            cls._parse_time(window["end"]),
+            None if days is None else frozenset(days),
+            window.get("max_bytes_per_second"),
+        )
+
+    @property
+    def limited(self):
+        return self._rate is not None or bool(self._windows)
+
+    def current_rate(self, now=None):
+        """
+        :param now: a datetime, defaults to the local time
+        :return: the maximum number of bytes per second at now, None for no limit
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        minutes = now.hour * 60 + now.minute
+        for start, end, days, rate in self._windows:
+            if start <= end:
+                inside = start <= minutes < end
+                day = now.weekday()
+            else:
+                inside = minutes >= start or minutes < end
+                # After midnight, the window started the day before
+                day = now.weekday() if minutes >= start else (now.weekday() - 1) % 7
+            if inside and (days is None or day in days):
+                return rate
+        return self._rate
+
+    def wait_window(self):
+        """
+        Wait while the downloads are paused, before a file is started
+        """
+        while True:
+            rate = self.current_rate()
+            with self._lock:
+                if rate != 0:
+                    if self._paused:
+                        self._paused = False
+                        self.logger.info("Downloads resumed")
+                    return
+                if not self._paused:
+                    self._paused = True
+                    self.logger.info("Downloads paused by the bandwidth windows")
+            time.sleep(self.pause_interval)
+
+    def consume(self, size):
+        """
+        Account for size bytes received, waiting as long as needed to stay under the current rate
+        """
+        rate = self.current_rate()
+        if rate == 0:
+            # A file started before the pause
+            rate = self._rate
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(rate, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            # A debt is paid by sleeping: the next callers wait behind it
+            self._tokens -= size
+            delay = -self._tokens / rate
+        if delay > 0:
+            pypisync.SyncMetrics.current().observe("bandwidth_wait_seconds", delay)
+            time.sleep(delay)
@@ -0,0 +1,100 @@
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class BlobStore:
+    """
+    Content addressed storage of the synced files.
+
+    Each file is stored once, under its sha256, and materialized in the destination folders (flat or simple layout)
+    as a hardlink to the blob. When a hardlink is not possible (another file system), a reflink is tried, then a copy.
+    Several configurations sharing the same store never download the same file twice.
+    """
+    logger = logging.getLogger(__name__)
+
+    # ioctl request cloning a whole file on Linux (btrfs, xfs, ...)
+    FICLONE = 0x40049409
+
+    def __init__(self, folder):
+        """
+        :param folder: the root folder of the blobs
+        """
+        self._folder = folder
+
+    @property
+    def folder(self):
+        return self._folder
+
+    def path(self, file_hash):
+        """
+        :return: the path of the blob of file_hash
+        """
+        return os.path.join(self._folder, file_hash[:2], file_hash[2:4], file_hash)
+
+    def __contains__(self, file_hash):
+        return os.path.exists(self.path(file_hash))
+
+    @classmethod
+    def _reflink(cls, source, destination):
+        if fcntl is None:
+            raise OSError(errno.EOPNOTSUPP, "reflink is not supported on this platform")
+        with open(source, "rb") as source_fp, open(destination, "wb") as destination_fp:
+            fcntl.ioctl(destination_fp.fileno(), cls.FICLONE, source_fp.fileno())
+
+    @classmethod
+    def _link(cls, source, destination):
+        """
+        Create destination with the content of source: hardlink, else reflink, else copy.
+        destination is replaced atomically.
+        """
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        tmp_destination = "%s.%d.tmp" % (destination, os.getpid())
+        try:
+            os.link(source, tmp_destination)
+        except OSError:
+            try:
+                cls._reflink(source, tmp_destination)
+            except OSError:
+                cls.logger.debug("Cannot link %s to %s, copying it", source, destination)
+                shutil.copyfile(source, tmp_destination)
+        os.replace(tmp_destination, destination)
+
+    def add(self, filename, file_hash):
+        """
+        Store an existing file, unless its content is already stored
+        :param filename: the file
+        :param file_hash: its sha256
+        """
+        if file_hash in self:
+            return
+        self.logger.debug("Storing %s as %s", filename, file_hash)
+        self._link(filename, self.path(file_hash))
+
+    def materialize(self, file_hash, filename):
+        """
+        Create filename from the blob of file_hash
+        :return: False if the content is not stored
+        """
+        blob = self.path(file_hash)
+        if not os.path.exists(blob):
+            return False
+        if os.path.exists(filename) and os.path.samefile(blob, filename):
+            return True
+        self._link(blob, filename)
+        return True
+
+    def discard(self, file_hash):
+        """
+        Remove the blob of file_hash, if it exists
+        """
+        try:
+            os.unlink(self.path(file_hash))
+        except FileNotFoundError:
+            pass
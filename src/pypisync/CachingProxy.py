@@ -0,0 +1,417 @@
+import collections
+import http.client
+import http.server
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+import packaging.utils
+import pypi_simple
+import requests
+
+import pypisync
+
+
+class _Fetch:
+    """
+    A file being fetched from upstream, followed by all the clients asking for it
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.part_filename = None
+        self.written = 0
+        self.done = False
+        self.error = None
+
+    def progress(self, part_filename, written):
+        with self.condition:
+            self.part_filename = part_filename
+            self.written = written
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Same as http.server.ThreadingHTTPServer, which needs Python 3.7
+    """
+    daemon_threads = True
+
+
+class CachingProxy:
+    """
+    Pull-through cache of an upstream index, serving the simple layout.
+
+    The project pages (/simple/<project>/, PEP 503 and PEP 691) are built from the JSON API with the PypiConnector,
+    revalidated at most every project_ttl seconds. A file that is not in the destination folder yet is downloaded like
+    the sync does, and streamed to the clients while it is written: the concurrent requests of the same file share a
+    single download.
+    """
+    logger = logging.getLogger(__name__)
+
+    default_project_ttl = 600
+    chunk_size = 64 * 1024
+    json_content_type = "application/vnd.pypi.simple.v1+json"
+    # The files of the pages served that are remembered, the next ones ask upstream for their page again
+    max_files = 100000
+    max_projects = 10000
+    hash_re = re.compile(r"^[0-9a-f]{64}$")
+    project_name_re = re.compile(r"^([A-Z0-9]|[A-Z0-9][A-Z0-9._-]*[A-Z0-9])$", re.IGNORECASE)
+    # Upstream cannot be reached: 503. Else it answered something unexpected: 502
+    unreachable_errors = (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError, socket.gaierror)
+    upstream_errors = (
+        requests.RequestException,
+        pypisync.RetryableError,
+        http.client.HTTPException,
+        OSError,
+        ValueError,
+    )
+
+    def __init__(self, connector, destination_folder, address, arch_exclude=None, project_ttl=None):
+        """
+        :param connector: the PypiConnector of upstream
+        :param destination_folder: where the files are stored, in the simple layout
+        :param address: the (host, port) to listen on. Port 0 for any free port
+        :param arch_exclude: the files not served, see the "arch_exclude" configuration
+        :param project_ttl: how long a project page is served before asking upstream again, in seconds
+        """
+        self._connector = connector
+        self._destination_folder = destination_folder
+        self._packages_root = os.path.realpath(os.path.join(destination_folder, "packages"))
+        self._simple_root = os.path.join(destination_folder, "simple")
+        self._arch_exclude = arch_exclude
+        self._project_ttl = self.default_project_ttl if project_ttl is None else project_ttl
+        self._revalidated = collections.OrderedDict()
+        self._generator = pypisync.SimpleIndexGenerator(self._simple_root)
+        # The files of the pages served, by sha256, least recently served first
+        self._files = collections.OrderedDict()
+        self._fetches = {}
+        self._lock = threading.Lock()
+        self._server = _Server(address, self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d/" % (host, port)
+
+    @staticmethod
+    def _remember(cache, key, value, max_size):
+        """
+        Put a value in a least recently used cache
+        """
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+    def _project_files(self, project_name):
+        """
+        :return: the LightPackage of the files of a project, None if it does not exist
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._revalidated.get(project_name, -self._project_ttl) >= self._project_ttl:
+                self._connector.expire_project_info(project_name)
+                self._remember(self._revalidated, project_name, now, self.max_projects)
+        if not self._connector.project_exists(project_name):
+            return None
+        packages = self._connector.get_project_info(project_name, self._arch_exclude)
+        with self._lock:
+            for package in packages:
+                self._remember(
+                    self._files,
+                    pypisync.PypiPackage.get_hash_from_url(package.url)[1],
+                    package,
+                    self.max_files
+                )
+        return packages
+
+    def project_page(self, project_name):
+        """
+        :return: the content of the page of a project by format, None if it does not exist
+        """
+        packages = self._project_files(project_name)
+        if packages is None:
+            return None
+        package_root = os.path.join(self._simple_root, project_name)
+        files = []
+        for package in packages:
+            _, file_hash = pypisync.PypiPackage.get_hash_from_url(package.url)
+            local_file = pypisync.PypiPackage.layout_filename(
+                package.filename,
+                file_hash,
+                self._destination_folder,
+                True
+            )
+            files.append((
+                package.filename,
+                os.path.relpath(local_file, package_root),
+                file_hash,
+                package.version,
+                package.size,
+                json.dumps(package.yanked) if package.yanked else None
+            ))
+        files.sort()
+        return self._generator.render_project(project_name, files)
+
+    def local_file(self, file_hash, filename):
+        """
+        :return: where a file of the simple layout is stored, None if file_hash or filename do not name one
+        """
+        if self.hash_re.fullmatch(file_hash) is None:
+            return None
+        if filename in ("", ".", "..") or "\0" in filename or any(
+                separator in filename for separator in ("/", os.sep, os.altsep) if separator
+        ):
+            return None
+        local_file = pypisync.PypiPackage.layout_filename(filename, file_hash, self._destination_folder, True)
+        resolved = os.path.realpath(local_file)
+        if os.path.commonpath([resolved, self._packages_root]) != self._packages_root:
+            return None
+        return local_file
+
+    @staticmethod
+    def _project_of(filename):
+        """
+        :return: the project name of a distribution file
+        """
+        try:
+            if filename.endswith(".whl"):
+                return packaging.utils.parse_wheel_filename(filename)[0]
+            return packaging.utils.parse_sdist_filename(filename)[0]
+        except (packaging.utils.InvalidWheelFilename, packaging.utils.InvalidSdistFilename):
+            return pypi_simple.normalize(filename.split("-")[0])
+
+    def _find_file(self, file_hash, filename):
+        """
+        :return: the LightPackage of a file, None if upstream does not have it
+        """
+        with self._lock:
+            package = self._files.get(file_hash)
+            if package is not None:
+                self._files.move_to_end(file_hash)
+        if package is None:
+            # Asked without its page, e.g. after a restart
+            self._project_files(self._project_of(filename))
+            with self._lock:
+                package = self._files.get(file_hash)
+        if package is None or package.filename != filename:
+            return None
+        return package
+
+    def _fetch(self, package):
+        """
+        Download a file, unless another client already asked for it
+        :return: the _Fetch following the download
+        """
+        file_hash = pypisync.PypiPackage.get_hash_from_url(package.url)[1]
+        with self._lock:
+            fetch = self._fetches.get(file_hash)
+            if fetch is not None:
+                return fetch
+            fetch = self._fetches[file_hash] = _Fetch()
+
+        def download():
+            error = None
+            try:
+                pypisync.PypiPackage(
+                    package.project,
+                    package.version,
+                    package.url,
+                    self._destination_folder,
+                    True,
+                    size=package.size,
+                    yanked=package.yanked
+                ).download(fetch.progress)
+            except Exception as e:
+                self.logger.error("Cannot fetch %s: %s", package.url, e)
+                error = e
+            finally:
+                with self._lock:
+                    del self._fetches[file_hash]
+                fetch.finish(error)
+
+        # Not bound to the client, which may go away before the end
+        threading.Thread(target=download, name="pypisync-fetch-%s" % file_hash[:8], daemon=True).start()
+        return fetch
+
+    def _stream(self, fetch, output, local_file):
+        """
+        Write a file to output while it is downloaded
+        :param local_file: where the file is once downloaded
+        :return: False if the download failed
+        """
+        with fetch.condition:
+            fetch.condition.wait_for(lambda: fetch.part_filename is not None or fetch.done)
+            part_filename = fetch.part_filename
+        fp = None
+        if part_filename is not None:
+            try:
+                fp = open(part_filename, "rb")
+            except FileNotFoundError:
+                # Already complete and renamed
+                pass
+        if fp is None:
+            with fetch.condition:
+                fetch.condition.wait_for(lambda: fetch.done)
+            if fetch.error is not None:
+                return False
+            with open(local_file, "rb") as fp:
+                shutil.copyfileobj(fp, output, self.chunk_size)
+            return True
+        position = 0
+        with fp:
+            while True:
+                with fetch.condition:
+                    fetch.condition.wait_for(lambda: fetch.written > position or fetch.done)
+                    if fetch.error is not None:
+                        return False
+                    available = fetch.written - position
+                    if available <= 0 and fetch.done:
+                        return True
+                fp.seek(position)
+                chunk = fp.read(min(available, self.chunk_size))
+                if not chunk:
+                    # Truncated by a download started again from scratch: the same content is written again
+                    with fetch.condition:
+                        fetch.condition.wait(0.1)
+                    continue
+                output.write(chunk)
+                position += len(chunk)
+
+    def _handler(self):
+        proxy = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                proxy.logger.debug("%s - %s", self.address_string(), format % args)
+
+            def _send(self, status, content=b"", content_type="text/plain", headers=()):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _send_file(self, filename):
+                with open(filename, "rb") as fp:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(os.fstat(fp.fileno()).st_size))
+                    self.end_headers()
+                    shutil.copyfileobj(fp, self.wfile, proxy.chunk_size)
+
+            def _send_upstream_error(self, error):
+                proxy.logger.error("Upstream failed for %s: %s", self.path, error)
+                if isinstance(error, proxy.unreachable_errors):
+                    self._send(503, b"Upstream Unavailable")
+                else:
+                    self._send(502, b"Bad Gateway")
+
+            def _project(self, name):
+                if proxy.project_name_re.fullmatch(name) is None:
+                    self._send(404, b"Not Found")
+                    return
+                normalized = pypi_simple.normalize(name)
+                if normalized != name:
+                    self._send(301, headers=[("Location", "/simple/%s/" % normalized)])
+                    return
+                try:
+                    contents = proxy.project_page(name)
+                except proxy.upstream_errors as e:
+                    self._send_upstream_error(e)
+                    return
+                if contents is None:
+                    self._send(404, b"Not Found")
+                elif proxy.json_content_type in self.headers.get("Accept", ""):
+                    self._send(200, contents["json"], proxy.json_content_type)
+                else:
+                    self._send(200, contents["html"], "text/html")
+
+            def _file(self, file_hash, filename):
+                local_file = proxy.local_file(file_hash, filename)
+                if local_file is None:
+                    self._send(404, b"Not Found")
+                    return
+                store = pypisync.PypiPackage.get_store()
+                if os.path.exists(local_file) or (store is not None and store.materialize(file_hash, local_file)):
+                    self._send_file(local_file)
+                    return
+                try:
+                    package = proxy._find_file(file_hash, filename)
+                except proxy.upstream_errors as e:
+                    self._send_upstream_error(e)
+                    return
+                if package is None:
+                    self._send(404, b"Not Found")
+                    return
+                fetch = proxy._fetch(package)
+                with fetch.condition:
+                    fetch.condition.wait_for(lambda: fetch.part_filename is not None or fetch.done)
+                if fetch.error is not None:
+                    self._send_upstream_error(fetch.error)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                if package.size is None:
+                    self.send_header("Connection", "close")
+                    self.close_connection = True
+                else:
+                    self.send_header("Content-Length", str(package.size))
+                self.end_headers()
+                if not proxy._stream(fetch, self.wfile, local_file):
+                    # The client sees a truncated file
+                    self.close_connection = True
+
+            def do_GET(self):
+                path = urllib.parse.urlparse(self.path).path
+                # Unquoted once split, so that an encoded "/" stays in its segment, where it is refused
+                tokens = [urllib.parse.unquote(x) for x in path.split("/") if x]
+                try:
+                    if len(tokens) == 2 and tokens[0] == "simple":
+                        self._project(tokens[1])
+                    elif len(tokens) == 5 and tokens[0] == "packages":
+                        self._file("".join(tokens[1:4]), tokens[4])
+                    else:
+                        self._send(404, b"Not Found")
+                except (BrokenPipeError, ConnectionResetError):
+                    proxy.logger.debug("%s went away", self.address_string())
+
+        return Handler
+
+    def serve_forever(self):
+        self.logger.info("Serving %s on %s", self._destination_folder, self.url)
+        self._server.serve_forever()
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+        self._generator.close()
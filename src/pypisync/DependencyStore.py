@@ -0,0 +1,83 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+class DependencyStore:
+    """
+    Persistent store of the dependencies of the files.
+
+    A file never changes once uploaded: its requirements, parsed and filtered with the environment markers, are kept
+    under (project, version, filename, sha256) and the environment. The next runs compute the closure from the store,
+    and only read the metadata of the new files.
+    """
+
+    def __init__(self, filename, environment_fingerprint):
+        """
+        :param filename: the sqlite database. None for a store that is not kept between runs
+        :param environment_fingerprint: identifies the environment the markers were evaluated with
+        """
+        self._environment = environment_fingerprint
+        self._lock = threading.Lock()
+        if filename is None:
+            filename = ":memory:"
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS dependencies ("
+                "project TEXT, "
+                "version TEXT, "
+                "filename TEXT, "
+                "sha256 TEXT, "
+                "environment TEXT, "
+                "requires TEXT, "
+                "PRIMARY KEY (project, version, filename, sha256, environment)"
+                ")"
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM dependencies WHERE environment = ?",
+                (self._environment,)
+            ).fetchone()[0]
+
+    def get(self, project, version, filename, sha256):
+        """
+        :return: the dependencies of the file, in the format of the "packages" config file parameter,
+                 None if they are not known
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT requires FROM dependencies "
+                "WHERE project = ? AND version = ? AND filename = ? AND sha256 = ? AND environment = ?",
+                (project, version, filename, sha256, self._environment)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict((name, set(specifiers)) for name, specifiers in json.loads(row[0]).items())
+
+    def put(self, project, version, filename, sha256, dependencies):
+        """
+        Store the dependencies of a file
+        :param dependencies: a dict, project name -> set of version specifiers
+        """
+        requires = json.dumps(
+            dict((name, sorted(specifiers)) for name, specifiers in dependencies.items()),
+            sort_keys=True,
+            separators=(",", ":")
+        )
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO dependencies "
+                    "(project, version, filename, sha256, environment, requires) VALUES (?, ?, ?, ?, ?, ?)",
+                    (project, version, filename, sha256, self._environment, requires)
+                )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,115 @@
+import concurrent.futures
+import logging
+import queue
+import threading
+import urllib.parse
+
+
+class _Unlimited:
+    """
+    No-op context manager, as contextlib.nullcontext which needs Python 3.7
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class DownloadScheduler:
+    """
+    Long lived pool of download workers shared by a whole sync run.
+
+    Tasks are submitted through a bounded queue: the producer (usually the ``packages()`` generator) blocks when the
+    workers are late, so that planning the next packages overlaps with the downloads without piling up the whole
+    mirror in memory.
+    """
+    logger = logging.getLogger(__name__)
+
+    default_workers = 8
+    default_per_host = 4
+    default_queue_size = 64
+
+    def __init__(self, workers=None, per_host=None, queue_size=None):
+        """
+        :param workers: number of worker threads (and global concurrency limit)
+        :param per_host: maximum number of concurrent tasks against the same host
+        :param queue_size: maximum number of tasks waiting for a worker
+        """
+        self._workers_count = workers or self.default_workers
+        self._per_host = per_host or self.default_per_host
+        self._queue = queue.Queue(maxsize=queue_size or self.default_queue_size)
+        self._hosts_semaphores = {}
+        self._hosts_lock = threading.Lock()
+        self._workers = []
+        self._started = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        for i in range(self._workers_count):
+            worker = threading.Thread(target=self._worker, name="pypisync-download-%d" % i, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def shutdown(self):
+        """
+        Wait for the queued tasks and stop the workers
+        """
+        if not self._started:
+            return
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._started = False
+
+    def _host_semaphore(self, url):
+        if url is None:
+            return _Unlimited()
+        host = urllib.parse.urlparse(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts_semaphores:
+                self._hosts_semaphores[host] = threading.BoundedSemaphore(self._per_host)
+            return self._hosts_semaphores[host]
+
+    def submit(self, url, function, *args, **kwargs):
+        """
+        Queue a task. Blocks while the queue is full.
+        :param url: the url the task will talk to, used for the per host limit. None for local only tasks
+        :param function: the callable to run in a worker
+        :return: a concurrent.futures.Future
+        """
+        self.start()
+        future = concurrent.futures.Future()
+        self._queue.put((future, url, function, args, kwargs))
+        return future
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                future, url, function, args, kwargs = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with self._host_semaphore(url):
+                        result = function(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            finally:
+                self._queue.task_done()
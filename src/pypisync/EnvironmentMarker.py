@@ -0,0 +1,312 @@
+import collections
+import functools
+import itertools
+import logging
+import operator
+import re
+import packaging.markers
+import packaging.specifiers
+import packaging.utils
+import packaging.version
+
+
+class EnvironmentMarker:
+    """
+    PEP 508 environment marker, evaluated against a configuration environment where each variable is either
+    None (any value is accepted) or a list of accepted values.
+
+    Each distinct marker is parsed once, into a tree of "and" and "or" nodes over (lhs, op, rhs) comparisons. The
+    variables with a list of values are enumerated. A variable that accepts any value is enumerated over witnesses
+    built from the literals it is compared to: each literal, its words, and values just below and above it, so that
+    each range of values the marker tells apart has one. A contradiction such as
+    'python_version < "2.7" and python_version >= "3"' is then false. The results are memoized per
+    (marker, environment).
+    """
+    logger = logging.getLogger(__name__)
+
+    # Value of a variable given an empty list: nothing may be equal to it
+    impossible_value = "____impossible_value____"
+    # Witness of the values equal to none of the literals
+    other_value = "____other_value____"
+    # Above this number of combinations, the variables that accept any value are evaluated symbolically: a
+    # comparison on such a variable is always true
+    max_combinations = 4096
+
+    Variable = collections.namedtuple("Variable", ("name",))
+
+    _token_re = re.compile(r"""
+        \s*(?:
+            (?P<string>'[^']*'|"[^"]*")
+            |(?P<op>===|==|!=|<=|>=|~=|<|>)
+            |(?P<paren>[()])
+            |(?P<word>[A-Za-z_][A-Za-z0-9_.]*)
+        )
+    """, re.VERBOSE)
+
+    # Legacy names of the variables, still accepted by packaging
+    _aliases = {
+        "os.name": "os_name",
+        "sys.platform": "sys_platform",
+        "platform.version": "platform_version",
+        "platform.machine": "platform_machine",
+        "platform.python_implementation": "platform_python_implementation",
+        "python_implementation": "platform_python_implementation",
+    }
+
+    _operators = {
+        "in": lambda lhs, rhs: lhs in rhs,
+        "not in": lambda lhs, rhs: lhs not in rhs,
+        "<": operator.lt,
+        "<=": operator.le,
+        "==": operator.eq,
+        "!=": operator.ne,
+        ">=": operator.ge,
+        ">": operator.gt,
+    }
+
+    # Variables whose values are names, normalized before comparison
+    _normalized_variables = ("extra",)
+
+    def __init__(self, marker):
+        """
+        :param marker: the marker string
+        :raise packaging.markers.InvalidMarker: if the marker cannot be parsed
+        """
+        # Rejects what pip rejects
+        packaging.markers.Marker(marker)
+        self._marker = marker
+        tokens = self._tokenize(marker)
+        tokens.reverse()
+        self._tree = self._parse_or(tokens)
+        if tokens:
+            raise packaging.markers.InvalidMarker("Unexpected %r in %r" % (tokens[-1][1], marker))
+        atoms = list(self._atoms(self._tree))
+        self._variables = sorted({
+            node.name
+            for _, lhs, _, rhs in atoms
+            for node in (lhs, rhs)
+            if isinstance(node, self.Variable)
+        })
+        self._witnesses = self._find_witnesses(atoms)
+
+    @classmethod
+    def _tokenize(cls, marker):
+        """
+        :return: the (kind, value) of the tokens of a marker
+        """
+        tokens = []
+        position = 0
+        while marker[position:].strip():
+            match = cls._token_re.match(marker, position)
+            if match is None:
+                raise packaging.markers.InvalidMarker("Unexpected %r in %r" % (marker[position:], marker))
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        return tokens
+
+    @staticmethod
+    def _expect(tokens, token):
+        if not tokens or tokens[-1] != token:
+            raise packaging.markers.InvalidMarker("Expected %r" % token[1])
+        tokens.pop()
+
+    def _parse_or(self, tokens):
+        nodes = [self._parse_and(tokens)]
+        while tokens and tokens[-1] == ("word", "or"):
+            tokens.pop()
+            nodes.append(self._parse_and(tokens))
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def _parse_and(self, tokens):
+        nodes = [self._parse_expression(tokens)]
+        while tokens and tokens[-1] == ("word", "and"):
+            tokens.pop()
+            nodes.append(self._parse_expression(tokens))
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def _parse_expression(self, tokens):
+        if tokens and tokens[-1] == ("paren", "("):
+            tokens.pop()
+            node = self._parse_or(tokens)
+            self._expect(tokens, ("paren", ")"))
+            return node
+        lhs = self._parse_value(tokens)
+        if tokens and tokens[-1][0] == "op":
+            op = tokens.pop()[1]
+        elif tokens and tokens[-1] == ("word", "not"):
+            tokens.pop()
+            self._expect(tokens, ("word", "in"))
+            op = "not in"
+        else:
+            self._expect(tokens, ("word", "in"))
+            op = "in"
+        return ("atom", lhs, op, self._parse_value(tokens))
+
+    def _parse_value(self, tokens):
+        """
+        :return: a Variable, or the string of a literal
+        """
+        if not tokens:
+            raise packaging.markers.InvalidMarker("Expected a variable or a string")
+        kind, value = tokens.pop()
+        if kind == "string":
+            return value[1:-1]
+        if kind == "word" and value not in ("and", "or", "in", "not"):
+            return self.Variable(self._aliases.get(value, value))
+        raise packaging.markers.InvalidMarker("Expected a variable or a string, got %r" % value)
+
+    @classmethod
+    def _atoms(cls, node):
+        if node[0] == "atom":
+            yield node
+        else:
+            for child in node[1]:
+                yield from cls._atoms(child)
+
+    @staticmethod
+    def _neighbours(literal):
+        """
+        :return: the literal, its words, and values just below and above it, as strings and as versions
+        """
+        values = {literal, literal + "~"}
+        values.update(literal.split())
+        if literal:
+            values.add(literal[:-1])
+        try:
+            version = packaging.version.Version(literal[:-2] if literal.endswith(".*") else literal)
+        except packaging.version.InvalidVersion:
+            return values
+        release = version.release
+        values.add(version.base_version)
+        for neighbour in (
+                release,
+                release + (0, 0, 0, 1),
+                release[:-1] + (release[-1] + 1,),
+        ):
+            values.add(".".join(str(x) for x in neighbour))
+        non_zero = [i for i, x in enumerate(release) if x]
+        if non_zero:
+            i = non_zero[-1]
+            values.add(".".join(str(x) for x in release[:i] + (release[i] - 1, 99999)))
+        return values
+
+    def _find_witnesses(self, atoms):
+        """
+        :return: {variable: witnesses}, without the variables compared to another variable
+        """
+        witnesses = {}
+        symbolic = set()
+        for _, lhs, _, rhs in atoms:
+            variables = [node.name for node in (lhs, rhs) if isinstance(node, self.Variable)]
+            if len(variables) == 2:
+                symbolic.update(variables)
+            elif variables:
+                literal = rhs if isinstance(lhs, self.Variable) else lhs
+                witnesses.setdefault(variables[0], {self.other_value}).update(self._neighbours(literal))
+        return {
+            variable: tuple(sorted(values))
+            for variable, values in witnesses.items()
+            if variable not in symbolic
+        }
+
+    @classmethod
+    def _compare(cls, lhs, op, rhs):
+        try:
+            specifier = packaging.specifiers.Specifier("".join([op, rhs]))
+            return specifier.contains(lhs, prereleases=True)
+        except (packaging.specifiers.InvalidSpecifier, packaging.version.InvalidVersion):
+            pass
+        if op not in cls._operators:
+            # "~=" or "===" on something else than a version: keep the dependency
+            return True
+        return cls._operators[op](lhs, rhs)
+
+    def _evaluate_atom(self, atom, assignment):
+        _, lhs, op, rhs = atom
+        values = []
+        normalize = False
+        for node in (lhs, rhs):
+            if isinstance(node, self.Variable):
+                if node.name in self._normalized_variables:
+                    normalize = True
+                if node.name not in assignment:
+                    # Any value is accepted for this variable
+                    return True
+                values.append(assignment[node.name])
+            else:
+                values.append(node)
+        if normalize:
+            values = [packaging.utils.canonicalize_name(x) for x in values]
+        return self._compare(values[0], op, values[1])
+
+    def _evaluate(self, node, assignment):
+        if node[0] == "atom":
+            return self._evaluate_atom(node, assignment)
+        if node[0] == "and":
+            return all(self._evaluate(child, assignment) for child in node[1])
+        return any(self._evaluate(child, assignment) for child in node[1])
+
+    def evaluate(self, environment_key):
+        """
+        :param environment_key: the environment, as returned by environment_key()
+        :return: True if at least one combination of the accepted values matches the marker
+        """
+        environment = dict(environment_key)
+        enumerated = [variable for variable in self._variables if environment.get(variable) is not None]
+        values = [environment[variable] or (self.impossible_value,) for variable in enumerated]
+        any_value = [
+            variable
+            for variable in self._variables
+            if environment.get(variable) is None and variable in self._witnesses
+        ]
+        witnesses = [self._witnesses[variable] for variable in any_value]
+        combinations = functools.reduce(operator.mul, (len(x) for x in values + witnesses), 1)
+        if combinations <= self.max_combinations:
+            enumerated += any_value
+            values += witnesses
+        for combination in itertools.product(*values):
+            if self._evaluate(self._tree, dict(zip(enumerated, combination))):
+                return True
+        return False
+
+    @staticmethod
+    def environment_key(environment):
+        """
+        :return: a hashable version of a configuration environment
+        """
+        return tuple(sorted(
+            (variable, None if values is None else tuple(values))
+            for variable, values in environment.items()
+        ))
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def compile(cls, marker):
+        """
+        :return: the EnvironmentMarker of a marker string, None if it is invalid
+        """
+        try:
+            return cls(marker)
+        except packaging.markers.InvalidMarker as e:
+            cls.logger.warning("Invalid environment marker %r: %s", marker, e)
+            return None
+
+    @classmethod
+    @functools.lru_cache(maxsize=65536)
+    def _evaluate_cached(cls, marker, environment_key):
+        compiled = cls.compile(marker)
+        if compiled is None:
+            # Keep the dependency: better download too much than a broken mirror
+            return True
+        return compiled.evaluate(environment_key)
+
+    @classmethod
+    def evaluate_marker(cls, marker, environment):
+        """
+        :param marker: the marker string
+        :param environment: the configuration environment, None to accept everything
+        :return: True if the marker matches the environment
+        """
+        if environment is None:
+            return True
+        return cls._evaluate_cached(marker, cls.environment_key(environment))
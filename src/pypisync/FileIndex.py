@@ -0,0 +1,151 @@
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import threading
+
+import pypisync
+
+
+class FileIndex:
+    """
+    Persistent index of the local files: path -> size, mtime and sha256.
+
+    The files already synced are recognized from the index and a stat, without hashing them again nor contacting
+    upstream. The index is built once with a parallel walk of the destination folder, then updated as the files land.
+    The sha256 of a file found by the walk is only computed the first time the file is looked up.
+    """
+    logger = logging.getLogger(__name__)
+
+    default_scan_workers = 8
+    # Not indexed: the incomplete downloads and the temporary files
+    ignored_suffixes = (".part", ".tmp")
+
+    def __init__(self, filename, scan_workers=None):
+        """
+        :param filename: the sqlite database. None for an index that is not kept between runs
+        :param scan_workers: the number of threads walking the folders
+        """
+        self._scan_workers = scan_workers or self.default_scan_workers
+        self._lock = threading.Lock()
+        if filename is None:
+            filename = ":memory:"
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, "
+                "size INTEGER, "
+                "mtime INTEGER, "
+                "sha256 TEXT"
+                ")"
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def get(self, path):
+        """
+        :return: the (size, mtime, sha256) of path, None if it is not indexed
+        """
+        with self._lock:
+            return self._db.execute("SELECT size, mtime, sha256 FROM files WHERE path = ?", (path,)).fetchone()
+
+    def record(self, path, sha256=None):
+        """
+        Index a file as it is on the disk
+        :param path: the file
+        :param sha256: its sha256 if known
+        """
+        stat = os.stat(path)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime_ns, sha256)
+                )
+
+    def forget(self, path):
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def is_complete(self, path, size, sha256):
+        """
+        :param path: the file
+        :param size: its expected size, None if unknown
+        :param sha256: its expected sha256
+        :return: True if path exists with the expected size and sha256
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.forget(path)
+            return False
+        if size is not None and stat.st_size != size:
+            return False
+        entry = self.get(path)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns or entry[2] is None:
+            # Unknown or modified since indexed: hashed once, then remembered
+            self.logger.debug("Indexing %s", path)
+            self.record(path, pypisync.HttpDownloader.hash_file(path).hexdigest())
+            entry = self.get(path)
+        return entry[2] == sha256
+
+    def _scan_folder(self, folder):
+        """
+        :return: the (path, size, mtime) of the files of folder, and its sub folders
+        """
+        files = []
+        folders = []
+        # os.scandir is a context manager since Python 3.6 only, the iterator is closed once exhausted
+        for entry in os.scandir(folder):
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith("."):
+                    folders.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(self.ignored_suffixes):
+                stat = entry.stat(follow_symlinks=False)
+                files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+        return files, folders
+
+    def walk(self, folder):
+        """
+        Walk folder in parallel. The hidden folders, the incomplete downloads and the temporary files are ignored.
+        :return: the (path, size, mtime) of the files found
+        """
+        found = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._scan_workers) as executor:
+            pending = {executor.submit(self._scan_folder, folder)}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for result in done:
+                    files, folders = result.result()
+                    found.extend(files)
+                    pending.update(executor.submit(self._scan_folder, x) for x in folders)
+        return found
+
+    def scan(self, folder):
+        """
+        Walk folder and index its files. The sha256 of the files that did not change since they were indexed is kept.
+        :return: the number of files found
+        """
+        found = self.walk(folder)
+        with self._lock:
+            known = dict(
+                ((row[0], (row[1], row[2])), row[3])
+                for row in self._db.execute("SELECT path, size, mtime, sha256 FROM files")
+            )
+            with self._db:
+                self._db.execute("DELETE FROM files")
+                self._db.executemany(
+                    "INSERT INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                    ((path, size, mtime, known.get((path, (size, mtime)))) for path, size, mtime in found)
+                )
+        return len(found)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import mmap
+import os
+import time
+import requests
+import requests.adapters
+
+import pypisync
+
+
+class HashMismatchError(Exception):
+    """
+    The downloaded content does not match the expected sha256
+    """
+    def __init__(self, url, expected, actual):
+        super().__init__("sha256 mismatch for %s: expected %s, got %s" % (url, expected, actual))
+        self.url = url
+        self.expected = expected
+        self.actual = actual
+
+
+class HttpDownloader:
+    """
+    Streaming http downloader.
+
+    The connections are pooled per host and reused between the downloads. Files are written in a ".part" file next to
+    the destination, resumed with a Range request when it already exists, then renamed in place.
+    """
+    logger = logging.getLogger(__name__)
+
+    default_chunk_size = 1024 * 1024
+    hash_buffer_size = 16 * 1024 * 1024
+    default_timeout = 60
+    part_suffix = ".part"
+
+    def __init__(self, pool_size=10, chunk_size=None, timeout=None, policy=None, bandwidth=None):
+        """
+        :param pool_size: the number of connections kept alive for each host
+        :param chunk_size: the size of the chunks written to the disk
+        :param timeout: connect and read timeout, in seconds
+        :param policy: the pypisync.RequestPolicy of the requests. The interrupted downloads are resumed when retried
+        :param bandwidth: the pypisync.BandwidthLimiter shared by all the downloads, None for no limit
+        """
+        self._chunk_size = chunk_size or self.default_chunk_size
+        self._timeout = timeout or self.default_timeout
+        self._policy = policy or pypisync.RequestPolicy()
+        self._bandwidth = bandwidth
+        self._session = requests.Session()
+        self._session.headers["User-Agent"] = pypisync.USER_AGENT
+        # The files are stored as is, range requests have no meaning on an encoded content
+        self._session.headers["Accept-Encoding"] = "identity"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @classmethod
+    def hash_file(cls, filename, sha256=None):
+        """
+        Compute the sha256 of a file.
+        The file is mapped in memory when possible so that the whole hashing runs without the GIL.
+        :param filename: the file to hash
+        :param sha256: a hashlib object to update. A new one is created if None
+        :return: the hashlib object
+        """
+        if sha256 is None:
+            sha256 = hashlib.sha256()
+        with open(filename, "rb") as fp:
+            try:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    sha256.update(mapped)
+            except (ValueError, OSError):
+                # Empty file, or a file system that does not support mmap
+                fp.seek(0)
+                for block in iter(lambda: fp.read(cls.hash_buffer_size), b""):
+                    sha256.update(block)
+        return sha256
+
+    def download(self, url, filename, expected_hash=None, progress=None):
+        """
+        Download url into filename.
+        Nothing is done if filename exists, as it is only created once complete.
+        :param url: the url to download
+        :param filename: the destination file
+        :param expected_hash: the expected sha256 of the file, checked while the content is streamed
+        :param progress: called with the part file and its size each time a chunk is written to it
+        """
+        if os.path.exists(filename):
+            self.logger.debug("Already downloaded: %s", filename)
+            return
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        part_filename = filename + self.part_suffix
+
+        sha256, resumed = self._policy.call(url, self._download_part, url, part_filename, progress)
+        if expected_hash is not None and sha256.hexdigest() != expected_hash:
+            os.unlink(part_filename)
+            if resumed:
+                # The beginning of the file may be the corrupted part: start again from scratch
+                self.logger.warning("sha256 mismatch on resumed %s, downloading it again", filename)
+                sha256, _ = self._policy.call(url, self._download_part, url, part_filename, progress)
+            if sha256.hexdigest() != expected_hash:
+                if os.path.exists(part_filename):
+                    os.unlink(part_filename)
+                raise HashMismatchError(url, expected_hash, sha256.hexdigest())
+        os.replace(part_filename, filename)
+
+    def _download_part(self, url, part_filename, progress=None):
+        """
+        Download or resume the part file
+        :return: the sha256 of the whole part file and whether the download was resumed
+        """
+        headers = {}
+        offset = 0
+        if os.path.exists(part_filename):
+            offset = os.path.getsize(part_filename)
+        if offset > 0:
+            headers["Range"] = "bytes=%d-" % offset
+
+        if self._bandwidth is not None:
+            # Before the connection is opened: it would time out during a pause
+            self._bandwidth.wait_window()
+        sha256 = hashlib.sha256()
+        start = time.perf_counter()
+        received = 0
+        with self._session.get(url, headers=headers, stream=True, timeout=self._timeout) as response:
+            if response.status_code == 416:
+                # The part file is already complete
+                self.logger.debug("Nothing left to download for %s", part_filename)
+                return self.hash_file(part_filename, sha256), True
+            response.raise_for_status()
+            mode = "wb"
+            resumed = offset > 0 and response.status_code == 206
+            if resumed:
+                self.logger.debug("Resuming %s at %d", part_filename, offset)
+                self.hash_file(part_filename, sha256)
+                mode = "ab"
+            with open(part_filename, mode) as fp:
+                for chunk in response.iter_content(chunk_size=self._chunk_size):
+                    sha256.update(chunk)
+                    fp.write(chunk)
+                    received += len(chunk)
+                    if self._bandwidth is not None:
+                        self._bandwidth.consume(len(chunk))
+                    if progress is not None:
+                        # Readers of the part file must see what is reported
+                        fp.flush()
+                        progress(part_filename, fp.tell())
+        self._record_metrics(received, time.perf_counter() - start)
+        return sha256, resumed
+
+    @staticmethod
+    def _record_metrics(received, duration):
+        metrics = pypisync.SyncMetrics.current()
+        metrics.increment("downloaded_files")
+        metrics.increment("download_bytes", received)
+        metrics.observe("download_seconds", duration)
+        if duration > 0:
+            metrics.observe("download_bytes_per_second", received / duration, pypisync.SyncMetrics.rate_buckets)
@@ -0,0 +1,86 @@
+import collections
+import json
+import os
+import sqlite3
+import threading
+
+
+class ProjectInfoCache:
+    """
+    Persistent cache of the JSON API project information.
+
+    The parsed files of each project are stored in a sqlite database along with the ETag and Last-Modified headers of
+    the response so that the next runs can send conditional requests. The most recently used projects are also kept
+    in memory, up to max_entries.
+    """
+
+    default_max_entries = 4096
+
+    def __init__(self, filename, max_entries=None):
+        """
+        :param filename: the sqlite database. None for a memory only cache
+        :param max_entries: the number of projects kept in memory
+        """
+        self._max_entries = max_entries or self.default_max_entries
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if filename is None:
+            filename = ":memory:"
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS projects ("
+                "name TEXT PRIMARY KEY, "
+                "etag TEXT, "
+                "last_modified TEXT, "
+                "packages TEXT"
+                ")"
+            )
+
+    def _remember(self, name, entry):
+        self._memory[name] = entry
+        self._memory.move_to_end(name)
+        while len(self._memory) > self._max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, name):
+        """
+        :param name: the project name
+        :return: a (etag, last_modified, rows) tuple, or None if the project is unknown
+        """
+        with self._lock:
+            if name in self._memory:
+                self._memory.move_to_end(name)
+                return self._memory[name]
+            row = self._db.execute(
+                "SELECT etag, last_modified, packages FROM projects WHERE name = ?",
+                (name,)
+            ).fetchone()
+            if row is None:
+                return None
+            entry = (row[0], row[1], [tuple(x) for x in json.loads(row[2])])
+            self._remember(name, entry)
+            return entry
+
+    def put(self, name, etag, last_modified, rows):
+        """
+        Store the information of a project
+        :param name: the project name
+        :param etag: the ETag header of the response
+        :param last_modified: the Last-Modified header of the response
+        :param rows: a list of tuples, the LightPackage fields
+        """
+        rows = [tuple(x) for x in rows]
+        with self._lock:
+            self._remember(name, (etag, last_modified, rows))
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO projects (name, etag, last_modified, packages) VALUES (?, ?, ?, ?)",
+                    (name, etag, last_modified, json.dumps(rows, separators=(",", ":")))
+                )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
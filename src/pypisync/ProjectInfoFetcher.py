@@ -0,0 +1,80 @@
+import asyncio
+import concurrent.futures
+import logging
+
+
+class ProjectInfoFetcher:
+    """
+    Fetch the information of a whole frontier of projects concurrently.
+
+    The blocking fetch function (sharing the connector session and its connection pool) runs in a thread pool driven by
+    an asyncio event loop, with at most max_in_flight requests at a time. The results are handed over as they arrive,
+    so that the caller works on them while the next ones are fetched.
+
+    Resolving a dependency closure frontier by frontier makes its duration depend on the depth of the dependency tree
+    instead of the number of projects.
+    """
+    logger = logging.getLogger(__name__)
+
+    default_max_in_flight = 16
+
+    def __init__(self, fetch, max_in_flight=None):
+        """
+        :param fetch: the blocking function called with each project name
+        :param max_in_flight: the maximum number of concurrent calls
+        """
+        self._fetch = fetch
+        self._max_in_flight = max_in_flight or self.default_max_in_flight
+
+    @property
+    def max_in_flight(self):
+        return self._max_in_flight
+
+    async def _fetch_one(self, loop, executor, name):
+        try:
+            return name, await loop.run_in_executor(executor, self._fetch, name)
+        except Exception as e:
+            # The caller gets the error again when it asks for this project
+            self.logger.debug("Cannot prefetch %s: %s", name, e)
+            return name, None
+
+    def fetch(self, names):
+        """
+        Call fetch with each name, max_in_flight at a time. names is only consumed as the calls complete, so that a
+        frontier of any size is fetched with a window of max_in_flight names in memory.
+        :param names: an iterable of project names
+        :return: a generator of (project name, result of fetch), in the order the calls complete. The result is None
+                 when the call failed
+        """
+        names = iter(names)
+        exhausted = False
+        in_flight = {}
+        loop = asyncio.new_event_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_in_flight)
+        try:
+            while True:
+                while not exhausted and len(in_flight) < self._max_in_flight:
+                    try:
+                        name = next(names)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if name not in in_flight:
+                        in_flight[name] = loop.create_task(self._fetch_one(loop, executor, name))
+                if not in_flight:
+                    return
+                done, _ = loop.run_until_complete(
+                    asyncio.wait(list(in_flight.values()), return_when=asyncio.FIRST_COMPLETED)
+                )
+                for task in done:
+                    name, result = task.result()
+                    del in_flight[name]
+                    yield name, result
+        finally:
+            # Left before the end by the caller
+            for task in in_flight.values():
+                task.cancel()
+            if in_flight:
+                loop.run_until_complete(asyncio.wait(list(in_flight.values())))
+            executor.shutdown()
+            loop.close()
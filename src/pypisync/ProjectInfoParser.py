@@ -0,0 +1,156 @@
+import codecs
+import json
+import re
+import urllib.parse
+
+import pypisync
+
+
+class ProjectInfoParser:
+    """
+    Incremental parser of the JSON API project documents.
+
+    The document is read chunk by chunk and its "releases" are walked file by file: only the current chunk and the
+    file being parsed are held in memory, instead of the raw body, its decoded text and the whole parsed document.
+    The other members ("info", "urls", ...) are small and parsed as a whole.
+    """
+
+    _whitespace = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, url, chunks):
+        """
+        :param url: the url of the document, the files urls are relative to it
+        :param chunks: an iterable of bytes, the document
+        """
+        self._url = url
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = 0
+        self._eof = False
+        self._name = None
+
+    def _fill(self):
+        """
+        Read the next chunk
+        :return: False at the end of the document
+        """
+        if self._eof:
+            return False
+        try:
+            chunk = self._text_decoder.decode(next(self._chunks))
+        except StopIteration:
+            chunk = self._text_decoder.decode(b"", final=True)
+            self._eof = True
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def _peek(self):
+        """
+        :return: the next non blank character, "" at the end of the document
+        """
+        while True:
+            self._position = self._whitespace.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill():
+                return ""
+
+    def _expect(self, character):
+        found = self._peek()
+        if found != character:
+            raise ValueError("Expected %r at %d, found %r in %s" % (character, self._position, found, self._url))
+        self._position += 1
+
+    def _value(self):
+        """
+        :return: the next JSON value
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number may go on in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._position = end
+            return value
+
+    def _members(self):
+        """
+        Walk the keys of an object, the caller reads each value
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self._position += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            yield key
+            if self._peek() == ",":
+                self._position += 1
+                continue
+            self._expect("}")
+            return
+
+    def _items(self):
+        """
+        Walk the items of an array
+        """
+        self._expect("[")
+        if self._peek() == "]":
+            self._position += 1
+            return
+        while True:
+            yield self._value()
+            if self._peek() == ",":
+                self._position += 1
+                continue
+            self._expect("]")
+            return
+
+    def _package(self, version, variant):
+        sha256 = variant["digests"]["sha256"]
+        return pypisync.LightPackage(
+            self._name,
+            version,
+            variant["filename"],
+            # Some endpoints give urls relative to the JSON document
+            "%s#sha256=%s" % (urllib.parse.urljoin(self._url, variant["url"]), sha256),
+            # The reason when there is one, as in PEP 691
+            (variant.get("yanked_reason") or True) if variant["yanked"] else False,
+            variant.get("size"),
+        )
+
+    def __iter__(self):
+        """
+        :return: the LightPackage of each file, yielded while the document is read
+        """
+        # PyPI sends "info" first. Otherwise, the files have to wait for the project name
+        pending = []
+        for key in self._members():
+            if key == "info":
+                self._name = self._value()["name"]
+                for version, variant in pending:
+                    yield self._package(version, variant)
+                pending = []
+            elif key == "releases":
+                for version in self._members():
+                    for variant in self._items():
+                        if self._name is None:
+                            pending.append((version, variant))
+                        else:
+                            yield self._package(version, variant)
+            else:
+                self._value()
+        if self._peek() != "":
+            raise ValueError("Extra data after the document in %s" % self._url)
+        if pending:
+            raise ValueError("No project information in %s" % self._url)
@@ -0,0 +1,119 @@
+import logging
+import re
+
+
+class ProjectNameFilter:
+    """
+    Match project names against all the "packages_re" patterns at once.
+
+    The patterns are bucketed by the first character of their literal prefix, and the patterns of a bucket are compiled
+    in a single regular expression: one optional lookahead with a named group per pattern, so that one match tells
+    which patterns apply. A name whose first character starts no literal prefix is only tried against the patterns that
+    have no literal prefix.
+    """
+    logger = logging.getLogger(__name__)
+
+    _special_characters = set(".^$*+?{}[]\\|()")
+    _quantifiers = set("*?{")
+    _backreference_re = re.compile(r"\\[1-9]|\(\?P=")
+    _inline_flags_re = re.compile(r"\(\?[aiLmsux]")
+    # Not scoped: before Python 3.11, they apply to the whole combined expression
+    _global_flags_re = re.compile(r"\(\?[aiLmsux]+\)")
+
+    def __init__(self, patterns):
+        """
+        :param patterns: dict of regular expression: versions specifiers, in the configuration order
+        """
+        self._patterns = patterns
+        self._indexes = {pattern: i for i, pattern in enumerate(patterns)}
+        buckets = {}
+        for pattern in patterns:
+            key = self.literal_prefix(pattern)[:1]
+            if key not in buckets:
+                buckets[key] = []
+            buckets[key].append(pattern)
+        unprefixed = buckets.pop("", [])
+        self._unprefixed = self._compile(unprefixed)
+        self._buckets = {key: self._compile(bucket) for key, bucket in buckets.items()}
+
+    @classmethod
+    def literal_prefix(cls, pattern):
+        """
+        :return: the literal characters any name matching pattern starts with, may be empty
+        """
+        if "|" in pattern or cls._inline_flags_re.search(pattern):
+            return ""
+        if pattern.startswith("^"):
+            pattern = pattern[1:]
+        prefix = []
+        for c in pattern:
+            if c in cls._special_characters:
+                if c in cls._quantifiers and prefix:
+                    # The last character is optional
+                    prefix.pop()
+                break
+            prefix.append(c)
+        return "".join(prefix)
+
+    def _compile(self, patterns):
+        """
+        :return: a list of (compiled regular expression, patterns); several items if some patterns cannot be combined
+        """
+        # Group numbers change once combined, and global flags would apply to the other patterns: such patterns are
+        # matched on their own
+        combinable = [
+            pattern
+            for pattern in patterns
+            if self._backreference_re.search(pattern) is None and self._global_flags_re.search(pattern) is None
+        ]
+        separate = [pattern for pattern in patterns if pattern not in combinable]
+        result = []
+        if combinable:
+            combined_str = "".join(
+                "(?:(?=(?P<p%d>%s)))?" % (self._indexes[pattern], pattern)
+                for pattern in combinable
+            )
+            try:
+                result.append((re.compile(combined_str), combinable))
+            except re.error as e:
+                # e.g. duplicated group names
+                self.logger.debug("Cannot combine the project names patterns: %s", e)
+                separate = patterns
+        for pattern in separate:
+            result.append((re.compile(pattern), None))
+        return result
+
+    def _match(self, compiled, name):
+        for regex, patterns in compiled:
+            match = regex.match(name)
+            if match is None:
+                continue
+            if patterns is None:
+                yield regex.pattern
+            else:
+                for pattern in patterns:
+                    if match.group("p%d" % self._indexes[pattern]) is not None:
+                        yield pattern
+
+    def matching(self, name):
+        """
+        :return: the patterns matching name, in the configuration order
+        """
+        result = list(self._match(self._unprefixed, name))
+        bucket = self._buckets.get(name[:1])
+        if bucket is not None:
+            result += self._match(bucket, name)
+        return sorted(result, key=self._indexes.get)
+
+    def filter(self, names):
+        """
+        :param names: an iterable of project names, consumed lazily
+        :return: a generator of (name, versions specifiers of all the matching patterns) for the matching names
+        """
+        for name in names:
+            patterns = self.matching(name)
+            if patterns:
+                specs = []
+                for pattern in patterns:
+                    specs += self._patterns[pattern]
+                yield name, specs
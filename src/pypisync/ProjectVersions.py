@@ -0,0 +1,120 @@
+import bisect
+import functools
+import packaging.specifiers
+import packaging.version
+
+
+class ProjectVersions:
+    """
+    Files of a project, indexed by version.
+    The versions are parsed and sorted once, so that selecting versions is a bisect and a filter.
+    """
+
+    # Operators of a specifier that give a lower bound for the matching versions
+    lower_bound_operators = (">=", ">", "==", "~=")
+
+    def __init__(self, packages):
+        """
+        :param packages: the LightPackage of the project
+        """
+        self._files = {}
+        for package in packages:
+            if package.version not in self._files:
+                self._files[package.version] = []
+            self._files[package.version].append(package)
+
+        versions = []
+        for version_str in self._files:
+            version = self.parse_version(version_str)
+            if version is not None:
+                versions.append((version, version_str))
+        versions.sort()
+        self._versions = [version for version, _ in versions]
+        self._versions_str = [version_str for _, version_str in versions]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def parse_version(version_str):
+        """
+        :return: the packaging.version.Version, None if invalid
+        """
+        try:
+            return packaging.version.Version(version_str)
+        except packaging.version.InvalidVersion:
+            return None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def parse_wanted(wanted):
+        """
+        :param wanted: a version specifier, or a strict version
+        :return: a packaging.specifiers.SpecifierSet, a packaging.version.Version or None if invalid
+        """
+        try:
+            return packaging.specifiers.SpecifierSet(wanted)
+        except packaging.specifiers.InvalidSpecifier:
+            return ProjectVersions.parse_version(wanted)
+
+    def _lower_bound(self, specifier_set):
+        """
+        :return: the index of the first version that can match specifier_set
+        """
+        index = 0
+        for specifier in specifier_set:
+            if specifier.operator in self.lower_bound_operators and not specifier.version.endswith(".*"):
+                bound = self.parse_version(specifier.version)
+                if bound is not None:
+                    index = max(index, bisect.bisect_left(self._versions, bound))
+        return index
+
+    def matching(self, wanted):
+        """
+        :param wanted: a version specifier, or a strict version
+        :return: the indexes of the matching versions, sorted
+        """
+        wanted = self.parse_wanted(wanted)
+        if wanted is None:
+            return []
+        if isinstance(wanted, packaging.version.Version):
+            start = bisect.bisect_left(self._versions, wanted)
+            end = bisect.bisect_right(self._versions, wanted)
+            return list(range(start, end))
+        return [
+            i
+            for i in range(self._lower_bound(wanted), len(self._versions))
+            if wanted.contains(self._versions[i])
+        ]
+
+    def latest(self, n, spec=None):
+        """
+        :param n: the number of latest versions wanted
+        :param spec: a version specifier the versions have to match, None for all the versions
+        :return: the oldest of the n latest versions matching spec, None if no version matches
+        """
+        if spec is None:
+            matching = list(range(len(self._versions)))
+        else:
+            matching = self.matching(spec)
+        if not matching:
+            return None
+        n = min(n, len(matching))
+        return self._versions[matching[-n]]
+
+    def keep_latest(self, indexes):
+        """
+        :param indexes: indexes of versions, sorted
+        :return: the indexes of the latest of the versions having a file that is not yanked
+        """
+        for i in reversed(indexes):
+            if any(not package.yanked for package in self._files[self._versions_str[i]]):
+                latest = self._versions[i]
+                return [j for j in indexes if self._versions[j] == latest]
+        return []
+
+    def files(self, indexes):
+        """
+        :return: the LightPackage of the given versions
+        """
+        for i in indexes:
+            for package in self._files[self._versions_str[i]]:
+                yield package
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
-import itertools
 import logging
-import re
 import urllib.parse
 import os
-import subprocess
+import sys
+import tarfile
+import threading
+import zipfile
 import pkginfo
 import packaging.requirements
 import pypisync
 
 
 class Hashable:
+    __slots__ = ()
+
     @property
     def _hash_value(self):
         raise NotImplementedError
@@ -51,33 +54,77 @@ class Hashable:
 
 
 class PypiPackage(Hashable):
-    logger = logging.getLogger(__name__)
     """
     Defines a package with its version
+
+    A full mirror holds millions of them in sets: the attributes are slots, and the key used for hashing and
+    comparisons is computed once.
     """
-    def __init__(self, name, version, url=None, destination_folder=None, simple=None, environment=None):
-        self._name = name
-        self._version = version
+    __slots__ = (
+        "_name",
+        "_version",
+        "_url",
+        "_size",
+        "_yanked",
+        "_file_hash",
+        "_destination_folder",
+        "_simple",
+        "_environment",
+        "_dependencies",
+        "_key",
+        "_hash",
+    )
+    logger = logging.getLogger(__name__)
+    _downloader = None
+    _downloader_lock = threading.Lock()
+    _store = None
+    _file_index = None
+    _dependency_store = None
+
+    def __init__(
+            self,
+            name,
+            version,
+            url=None,
+            destination_folder=None,
+            simple=None,
+            environment=None,
+            size=None,
+            yanked=False
+    ):
+        self._name = sys.intern(name)
+        self._version = None if version is None else sys.intern(version)
         self._url = url
-        self._local_file = None
+        self._size = size
+        self._yanked = yanked
         self._file_hash = None
         self._destination_folder = destination_folder
         self._simple = simple
         self._environment = environment
-        if self._url is not None and self._destination_folder is not None:
-            self._local_file, self._file_hash = self._create_filename(self.url, self._destination_folder, self._simple)
         self._dependencies = None
 
-    @property
-    def _hash_value(self):
-        value = (self._name,)
+        key = (self._name,)
         if self._version is not None:
-            value = value + (self._version,)
+            key = key + (self._version,)
         if self._url is not None:
-            value = value + (self.file_basename,)
-        if len(value) == 1:
-            value = value[0]
-        return value
+            file_basename, self._file_hash = self.get_hash_from_url(self._url)
+            key = key + (file_basename,)
+        if len(key) == 1:
+            key = key[0]
+        self._key = key
+        self._hash = hash(key)
+
+    @property
+    def _hash_value(self):
+        return self._key
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if other.__class__ is PypiPackage:
+            return self._hash == other._hash and self._key == other._key
+        return super().__eq__(other)
 
     @property
     def name(self):
@@ -91,92 +138,32 @@ class PypiPackage(Hashable):
     def url(self):
         return self._url
 
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def yanked(self):
+        """
+        :return: False, or the yank reason (True if no reason was given)
+        """
+        return self._yanked
+
     @property
     def local_file(self):
-        return self._local_file
+        # Not stored, to keep the packages small
+        if self._url is None or self._destination_folder is None:
+            return None
+        return self.layout_filename(self.file_basename, self._file_hash, self._destination_folder, self._simple)
 
     @property
     def file_hash(self):
         return self._file_hash
 
-    @staticmethod
-    def _find_suitable_value(variable, marker):
-        operators = [
-            r"\>=",
-            r"\<=",
-            r"\>",
-            r"\<",
-            "==",
-            "!=",
-            "in",
-        ]
-        variable_re_str = r".*%s *(?P<op>(%s)) *(?P<value>([^ ()]+)).*" % (variable, ")|(".join(operators))
-        variable_re = re.compile(variable_re_str)
-        match = variable_re.match(marker)
-        value = match.group("value")
-        for c in ['"', "'"]:
-            while c in value:
-                value = value.replace(c, "")
-        op = match.group("op")
-        matching_ops = [
-            "==",
-            ">=",
-            "<=",
-            "in"
-        ]
-        matching_value = None
-        if op in matching_ops:
-            matching_value = value
-        elif op == ">":
-            tokens = value.split(".")
-            tokens.append("1")
-            matching_value = ".".join(tokens)
-        elif op == "<":
-            tokens = value.split(".")
-            tokens[-1] = str(int(tokens[-1])-1)
-            tokens.append("9999")
-            matching_value = ".".join(tokens)
-        elif op == "!=":
-            matching_value = "%s.9999" % value
-
-        return matching_value
-
     @staticmethod
     def evaluate_env_marker(marker, environment):
-        if environment is None:
-            return True
-        variables = sorted(environment.keys())
-
-        evaluate_variables = {}
-
-        for variable in variables:
-            # get the markers elements
-            if variable in marker:
-                evaluate_variables[variable] = environment[variable]
-
-        if len(evaluate_variables) > 0:
-            # OK, need some work here
-            # If there are some None values, we need to replace it with a matching value in the evaluation context
-            for variable in evaluate_variables:
-                if evaluate_variables[variable] is None:
-                    evaluate_variables[variable] = [PypiPackage._find_suitable_value(variable, marker)]
-                elif len(evaluate_variables[variable]) == 0:
-                    # Add at least an impossible value here...
-                    evaluate_variables[variable] = ["____impossible_value____"]
-            # Evaluate with cross multiplication
-            tmp = []
-            for variable in sorted(evaluate_variables.keys()):
-                tmp.append(evaluate_variables[variable])
-            for values in itertools.product(*tmp):
-                # build a context
-                context = {}
-                for i, variable in enumerate(sorted(evaluate_variables.keys())):
-                    context[variable] = values[i]
-                result = eval(marker, {}, context)
-                if result:
-                    return result
-            return False
-        return True
+        with pypisync.SyncMetrics.current().timer("marker_evaluation"):
+            return pypisync.EnvironmentMarker.evaluate_marker(marker, environment)
 
     @staticmethod
     def _parse_requirement(requirement):
@@ -187,59 +174,161 @@ class PypiPackage(Hashable):
             env_marker = tokens[1]
         return version, env_marker
 
+    def _read_metadata(self):
+        """
+        Read the metadata from the local file if it exists, else from upstream without downloading the whole file.
+        Nothing is written: the files are only linked from the store by the fetch.
+        :return: a pkginfo.Distribution, or None if the file has to be downloaded first
+        """
+        if os.path.exists(self.local_file):
+            try:
+                return pkginfo.get_metadata(self.local_file)
+            except (ValueError, OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+                # Corrupted file, it will be downloaded again by the fetch
+                self.logger.warning("Cannot read the metadata of %s: %s", self.local_file, e)
+        downloader = self.get_downloader()
+        return pypisync.RemoteMetadata(downloader.session, downloader.timeout, downloader.policy).fetch(self.url)
+
     def dependencies(self):
         """
-        Read the dependencies in the local file
-        :return: same format as in the "packages" config file parameter
+        Read the dependencies of the package
+        :return: same format as in the "packages" config file parameter,
+                 or None if they cannot be known before downloading the file
         """
         if self._dependencies is None:
+            dependency_store = self.get_dependency_store()
+            if dependency_store is not None:
+                self._dependencies = dependency_store.get(
+                    self._name,
+                    self._version,
+                    self.file_basename,
+                    self._file_hash
+                )
+                if self._dependencies is not None:
+                    pypisync.SyncMetrics.current().increment("dependency_store_hits")
+                    return self._dependencies
+            metrics = pypisync.SyncMetrics.current()
+            with metrics.timer("metadata_read"):
+                metadata = self._read_metadata()
+            if metadata is None and not os.path.exists(self.local_file):
+                return None
             self._dependencies = {}
-            metadata = pkginfo.get_metadata(self._local_file)
 
             if metadata is not None:
-                for require in metadata.requires_dist:
-                    version, env_marker = PypiPackage._parse_requirement(require)
-                    version = packaging.requirements.Requirement(version)
-                    if env_marker is not None:
-                        if not PypiPackage.evaluate_env_marker(env_marker, self._environment):
-                            continue
-                    if version.name not in self._dependencies:
-                        self._dependencies[version.name] = set()
-                    specifier = str(version.specifier).strip()
-                    if specifier == "":
-                        specifier = "latest"
-                    if specifier not in self._dependencies[version.name]:
-                        self._dependencies[version.name].add(specifier)
+                with metrics.timer("dependencies"):
+                    for require in metadata.requires_dist:
+                        version, env_marker = PypiPackage._parse_requirement(require)
+                        version = packaging.requirements.Requirement(version)
+                        if env_marker is not None:
+                            if not PypiPackage.evaluate_env_marker(env_marker, self._environment):
+                                continue
+                        if version.name not in self._dependencies:
+                            self._dependencies[version.name] = set()
+                        specifier = str(version.specifier).strip()
+                        if specifier == "":
+                            specifier = "latest"
+                        if specifier not in self._dependencies[version.name]:
+                            self._dependencies[version.name].add(specifier)
+                if dependency_store is not None:
+                    dependency_store.put(
+                        self._name,
+                        self._version,
+                        self.file_basename,
+                        self._file_hash,
+                        self._dependencies
+                    )
         return self._dependencies
 
-    def _download_url(self, url, filename):
+    @classmethod
+    def set_downloader(cls, downloader):
+        """
+        Set the downloader shared by all the packages
+        :param downloader: a pypisync.HttpDownloader
+        """
+        with cls._downloader_lock:
+            cls._downloader = downloader
+
+    @classmethod
+    def get_downloader(cls):
+        with cls._downloader_lock:
+            if cls._downloader is None:
+                cls._downloader = pypisync.HttpDownloader()
+            return cls._downloader
+
+    @classmethod
+    def set_store(cls, store):
+        """
+        Set the blob store shared by all the packages
+        :param store: a pypisync.BlobStore, None to download the files in place
+        """
+        cls._store = store
+
+    @classmethod
+    def get_store(cls):
+        return cls._store
+
+    @classmethod
+    def set_file_index(cls, file_index):
+        """
+        Set the index of the local files shared by all the packages
+        :param file_index: a pypisync.FileIndex, None to only check that the local files exist
+        """
+        cls._file_index = file_index
+
+    @classmethod
+    def get_file_index(cls):
+        return cls._file_index
+
+    @classmethod
+    def set_dependency_store(cls, dependency_store):
+        """
+        Set the store of the dependencies shared by all the packages
+        :param dependency_store: a pypisync.DependencyStore, None to always read the metadata
+        """
+        cls._dependency_store = dependency_store
+
+    @classmethod
+    def get_dependency_store(cls):
+        return cls._dependency_store
+
+    def _materialize(self, verified=False):
+        """
+        Create the local file from the store if it is missing, else store it once its sha256 is checked
+        :param verified: True if the local file is already known to match its sha256
+        :return: True if the local file exists, False if it is missing or does not match its sha256
+        """
+        store = self.get_store()
+        if os.path.exists(self.local_file):
+            if store is None or self.file_hash in store:
+                return True
+            # Its blob is the content of every other layout of this file
+            if not verified and pypisync.HttpDownloader.hash_file(self.local_file).hexdigest() != self.file_hash:
+                self.logger.warning("%s does not match its sha256, it is not stored", self.local_file)
+                return False
+            store.add(self.local_file, self.file_hash)
+            return True
+        return store is not None and store.materialize(self.file_hash, self.local_file)
+
+    def _download_url(self, url, filename, file_hash, progress=None):
         self.logger.debug("Filename: %s", filename)
         self.logger.debug("URL: %s", url)
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-        # TODO: Pure python ?
-        subprocess.check_call(
-            [
-                "wget",
-                "-U", pypisync.USER_AGENT,
-                "-c",
-                url,
-                "-O",
-                filename
-            ],
-            stderr=subprocess.PIPE
-        )
+        self.get_downloader().download(url, filename, file_hash, progress)
 
     @staticmethod
-    def _get_hash_from_url(url):
-        file_hash = urllib.parse.urlparse(url).fragment.split("=")[1]
-        filename = os.path.basename(urllib.parse.urlparse(url).path)
+    def get_hash_from_url(url):
+        """
+        :return: the basename of a file and its sha256, from its url
+        """
+        parsed = urllib.parse.urlparse(url)
+        file_hash = parsed.fragment.split("=")[1]
+        filename = os.path.basename(parsed.path)
         return filename, file_hash
 
     @property
     def file_basename(self):
-        filename, _ = self._get_hash_from_url(self.url)
-        return os.path.basename(filename)
+        if self._url is None:
+            return None
+        return self._key[-1]
 
     @classmethod
     def _create_filename(cls, url, destination_folder, simple_layout):
@@ -247,7 +336,14 @@ class PypiPackage(Hashable):
         Create the filename from the url
         """
         # TODO: Do we really trust this ?
-        file_basename, file_hash = cls._get_hash_from_url(url)
+        file_basename, file_hash = cls.get_hash_from_url(url)
+        return cls.layout_filename(file_basename, file_hash, destination_folder, simple_layout), file_hash
+
+    @staticmethod
+    def layout_filename(file_basename, file_hash, destination_folder, simple_layout):
+        """
+        :return: the path of the file in the layout
+        """
         if simple_layout:
             path = [
                 destination_folder,
@@ -260,7 +356,57 @@ class PypiPackage(Hashable):
             filename = os.path.join(*path)
         else:
             filename = os.path.join(destination_folder, file_basename)
-        return filename, file_hash
+        return filename
 
-    def download(self):
-        self._download_url(self.url, self.local_file)
+    def download(self, progress=None):
+        """
+        Download the file, unless it is already synced or stored
+        :param progress: see HttpDownloader.download
+        """
+        file_index = self.get_file_index()
+        if file_index is not None:
+            if file_index.is_complete(self.local_file, self.size, self.file_hash):
+                self.logger.debug("Already synced: %s", self.local_file)
+                self._materialize(True)
+                return
+            if os.path.exists(self.local_file):
+                self.logger.warning("%s does not match upstream, downloading it again", self.local_file)
+                self.remove()
+        if self._materialize():
+            self.logger.debug("Already stored: %s", self.local_file)
+        else:
+            store = self.get_store()
+            if store is None:
+                self._download_url(self.url, self.local_file, self.file_hash, progress)
+            else:
+                self._download_url(self.url, store.path(self.file_hash), self.file_hash, progress)
+                store.materialize(self.file_hash, self.local_file)
+        if file_index is not None:
+            file_index.record(self.local_file, self.file_hash)
+
+    def remove(self):
+        """
+        Remove the local file, and its blob as they share the same content
+        """
+        if os.path.exists(self.local_file):
+            os.unlink(self.local_file)
+        store = self.get_store()
+        if store is not None:
+            store.discard(self.file_hash)
+        file_index = self.get_file_index()
+        if file_index is not None:
+            file_index.forget(self.local_file)
+
+    def verify(self):
+        """
+        Check the local file against the sha256 given by upstream
+        :return: True if the local file exists and matches
+        """
+        if not self._materialize():
+            return False
+        if pypisync.HttpDownloader.hash_file(self.local_file).hexdigest() != self.file_hash:
+            return False
+        file_index = self.get_file_index()
+        if file_index is not None:
+            file_index.record(self.local_file, self.file_hash)
+        return True
@@ -3,38 +3,70 @@ import os
 import logging
 import json
 import pypi_simple
+import collections
 import concurrent.futures
-import packaging.version
-import packaging.specifiers
 import re
+import sys
+import xmlrpc.client
 import requests
+import requests.adapters
 from tqdm import tqdm
 
 import pypisync
 
 
 class LightPackage:
-    def __init__(self, project, version, filename, url, yanked):
-        self.project = project
-        self.version = version
+    __slots__ = ("project", "version", "filename", "url", "yanked", "size")
+
+    def __init__(self, project, version, filename, url, yanked, size=None):
+        self.project = sys.intern(project)
+        self.version = sys.intern(version)
         self.filename = filename
         self.url = url
         self.yanked = yanked
+        self.size = size
 
 
 class PypiConnector:
+    logger = logging.getLogger(__name__)
     _xmlrpc_client = None
     _simple_client = None
     _endpoint_base = None
     _xmlrpc_endpoint = None
     _simple_endpoint = None
-    _project_info_cache = {}
+    _session = None
+    _project_info_cache = None
+    _revalidated = set()
+    _project_versions_cache = collections.OrderedDict()
+    _project_versions_cache_size = None
+    _project_info_fetcher = None
+    _policy = None
+    _multicall_chunk_size = None
+    _multicall_supported = True
+    json_chunk_size = 64 * 1024
+    default_multicall_chunk_size = 100
 
-    def __init__(self, endpoint_base):
-        self.initialize(endpoint_base)
+    def __init__(
+            self,
+            endpoint_base,
+            cache_file=None,
+            cache_size=None,
+            max_in_flight=None,
+            policy=None,
+            multicall_chunk_size=None
+    ):
+        self.initialize(endpoint_base, cache_file, cache_size, max_in_flight, policy, multicall_chunk_size)
 
     @classmethod
-    def initialize(cls, endpoint_base):
+    def initialize(
+            cls,
+            endpoint_base,
+            cache_file=None,
+            cache_size=None,
+            max_in_flight=None,
+            policy=None,
+            multicall_chunk_size=None
+    ):
         if endpoint_base is None:
             endpoint_base = "https://pypi.org/"
         while endpoint_base.endswith("/"):
@@ -47,130 +79,410 @@ class PypiConnector:
             cls._xmlrpc_endpoint,
             headers=[("User-Agent", pypisync.USER_AGENT)]
         )
+        cls._session = requests.Session()
+        cls._session.headers["User-Agent"] = pypisync.USER_AGENT
+        cls._project_info_fetcher = pypisync.ProjectInfoFetcher(cls._load_project_info, max_in_flight)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=cls._project_info_fetcher.max_in_flight,
+            pool_maxsize=cls._project_info_fetcher.max_in_flight
+        )
+        cls._session.mount("http://", adapter)
+        cls._session.mount("https://", adapter)
+        cls._project_info_cache = pypisync.ProjectInfoCache(cache_file, cache_size)
+        cls._revalidated = set()
+        cls._project_versions_cache = collections.OrderedDict()
+        cls._project_versions_cache_size = cache_size or pypisync.ProjectInfoCache.default_max_entries
+        cls._policy = policy or pypisync.RequestPolicy()
+        cls._multicall_chunk_size = multicall_chunk_size or cls.default_multicall_chunk_size
+        cls._multicall_supported = True
+
+    @staticmethod
+    def _xmlrpc_call(method, *args):
+        """
+        Call an XML-RPC method with the request policy
+        """
+        return PypiConnector._policy.call(
+            PypiConnector._xmlrpc_endpoint,
+            getattr(PypiConnector._xmlrpc_client, method),
+            *args
+        )
+
+    @staticmethod
+    def _xmlrpc_multicall(method, arguments):
+        """
+        Call an XML-RPC method once per arguments in a single system.multicall request
+        :return: the results, a xmlrpc.client.Fault for the calls that failed
+        """
+        multicall = xmlrpc.client.MultiCall(PypiConnector._xmlrpc_client)
+        for args in arguments:
+            getattr(multicall, method)(*args)
+        response = PypiConnector._policy.call(PypiConnector._xmlrpc_endpoint, multicall)
+        results = []
+        for i in range(len(arguments)):
+            try:
+                results.append(response[i])
+            except xmlrpc.client.Fault as e:
+                results.append(e)
+        return results
+
+    @staticmethod
+    def xmlrpc_batch(method, arguments):
+        """
+        Call an XML-RPC method once per arguments, batched with system.multicall by chunks of multicall_chunk_size.
+        When upstream does not support system.multicall, the calls are made one by one.
+        :param method: the method name, "package_releases" for example
+        :param arguments: a list of tuples, the arguments of each call
+        :return: the results in the same order, a xmlrpc.client.Fault for the calls that failed
+        """
+        arguments = list(arguments)
+        results = []
+        chunk_size = PypiConnector._multicall_chunk_size
+        for start in range(0, len(arguments), chunk_size):
+            chunk = arguments[start:start + chunk_size]
+            if PypiConnector._multicall_supported:
+                try:
+                    with pypisync.SyncMetrics.current().timer("xmlrpc_multicall"):
+                        results.extend(PypiConnector._xmlrpc_multicall(method, chunk))
+                    continue
+                except xmlrpc.client.Fault as e:
+                    PypiConnector.logger.warning("system.multicall is not supported (%s), calling one by one", e)
+                    PypiConnector._multicall_supported = False
+            for args in chunk:
+                try:
+                    results.append(PypiConnector._xmlrpc_call(method, *args))
+                except xmlrpc.client.Fault as e:
+                    results.append(e)
+        return results
 
     @staticmethod
     def get_projects_names():
-        return PypiConnector._xmlrpc_client.list_packages()
+        with pypisync.SyncMetrics.current().timer("xmlrpc_list"):
+            return PypiConnector._xmlrpc_call("list_packages")
+
+    @staticmethod
+    def get_last_serial():
+        """
+        :return: the serial of the last upstream change, None if the endpoint does not provide it
+        """
+        try:
+            return PypiConnector._xmlrpc_call("changelog_last_serial")
+        except (xmlrpc.client.Error, OSError) as e:
+            PypiConnector.logger.warning("Cannot get the last serial: %s", e)
+            return None
+
+    @staticmethod
+    def get_changed_projects(since_serial):
+        """
+        :return: the names of the projects that changed after since_serial
+        """
+        return set(entry[0] for entry in PypiConnector._xmlrpc_call("changelog_since_serial", since_serial))
+
+    @staticmethod
+    def _keep_package(package, arch_exclude):
+        if arch_exclude:
+            arch = package.filename.replace("%s-%s" % (package.project, package.version), "")
+            for exclude in arch_exclude:
+                if exclude in arch:
+                    return False
+        return True
 
     @staticmethod
     def get_project_info(project_name, arch_exclude):
-        if project_name not in PypiConnector._project_info_cache:
-            PypiConnector._project_info_cache[project_name] = list(PypiConnector.get_project_info_generator(project_name, arch_exclude))
-        return PypiConnector._project_info_cache[project_name]
+        """
+        Get the files of a project.
+        Upstream is asked at most once per run, with a conditional request when the project is already in the cache.
+        """
+        return list(PypiConnector.get_project_info_generator(project_name, arch_exclude))
 
     @staticmethod
-    def get_project_info_generator(project_name, arch_exclude):
+    def _load_project_info(project_name):
+        """
+        :return: the cache entry of a project, revalidated if it was not during this run. None if it does not exist
+        """
+        entry = PypiConnector._project_info_cache.get(project_name)
+        if project_name not in PypiConnector._revalidated:
+            entry = PypiConnector._revalidate_project_info(project_name, entry)
+            PypiConnector._revalidated.add(project_name)
+        return entry
+
+    @staticmethod
+    def project_exists(project_name):
+        """
+        :return: True if upstream knows the project
+        """
+        return PypiConnector._load_project_info(project_name) is not None
+
+    @staticmethod
+    def expire_project_info(project_name):
+        """
+        Ask upstream again the next time the project information is needed
+        """
+        PypiConnector._revalidated.discard(project_name)
+
+    @staticmethod
+    def prefetch_project_info(project_names):
+        """
+        Ask upstream for the information of several projects concurrently, so that the next get_project_info calls
+        are answered by the cache
+        :param project_names: an iterable of project names, consumed as the information arrives
+        :return: a generator of the project names, in the order their information arrives
+        """
+        for name, _ in PypiConnector._project_info_fetcher.fetch(project_names):
+            yield name
+
+    @staticmethod
+    def _revalidate_project_info(project_name, entry):
+        """
+        Ask upstream for the project information, unless it did not change since the cached entry
+        :return: the up to date cache entry, None if the project does not exist
+        """
         url = "%s%s/json" % (PypiConnector._xmlrpc_endpoint, project_name)
-        response = requests.get(url, allow_redirects=True)
-        if int(response.status_code) != 200:
-            return
-        content = response.content.decode()
-        data = json.loads(content)
-        name = data["info"]["name"]
-        for version in data["releases"]:
-            for variant in data["releases"][version]:
-                sha256 = variant["digests"]["sha256"]
-                package = LightPackage(
-                    name,
-                    version,
-                    variant["filename"],
-                    "%s#sha256=%s" % (variant["url"], sha256),
-                    variant["yanked"],
-                )
-                keep_it = True
-                if arch_exclude:
-                    arch = package.filename.replace("%s-%s" % (package.project, package.version), "")
-                    for exclude in arch_exclude:
-                        if exclude in arch:
-                            keep_it = False
+        headers = {}
+        if entry is not None:
+            etag, last_modified, _ = entry
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        metrics = pypisync.SyncMetrics.current()
+        with metrics.timer("json_api"):
+            response = PypiConnector._policy.call(
+                url,
+                PypiConnector._session.get,
+                url,
+                headers=headers,
+                allow_redirects=True,
+                stream=True
+            )
+        metrics.increment("json_api_requests")
+        with response:
+            if int(response.status_code) == 304:
+                metrics.increment("json_api_not_modified")
+                PypiConnector.logger.debug("Not modified: %s", project_name)
+                return entry
+            if int(response.status_code) in (404, 410):
+                return None
+            # Anything else than the project information must not be taken for a project without files
+            response.raise_for_status()
+            # The document is parsed while it is received, only the rows are kept
+            with metrics.timer("json_api_parse"):
+                rows = [
+                    (package.project, package.version, package.filename, package.url, package.yanked, package.size)
+                    for package in pypisync.ProjectInfoParser(
+                        response.url,
+                        response.iter_content(chunk_size=PypiConnector.json_chunk_size)
+                    )
+                ]
+        PypiConnector._project_info_cache.put(
+            project_name,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            rows
+        )
+        return PypiConnector._project_info_cache.get(project_name)
+
+    @staticmethod
+    def get_project_versions(project_name, arch_exclude):
+        """
+        :return: the files of a project indexed by version, see ProjectVersions
+        """
+        key = (project_name, tuple(arch_exclude or ()))
+        cache = PypiConnector._project_versions_cache
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            cache[key] = pypisync.ProjectVersions(PypiConnector.get_project_info(project_name, arch_exclude))
+            while len(cache) > PypiConnector._project_versions_cache_size:
+                cache.popitem(last=False)
+        return cache[key]
 
-                if keep_it:
-                    yield package
+    @staticmethod
+    def get_project_info_generator(project_name, arch_exclude):
+        """
+        Same as get_project_info, the files are built one by one
+        """
+        entry = PypiConnector._load_project_info(project_name)
+        if entry is None:
+            return
+        for row in entry[2]:
+            package = LightPackage(*row)
+            if PypiConnector._keep_package(package, arch_exclude):
+                yield package
 
 
 class PypiSync:
     logger = logging.getLogger(__name__)
 
-    def __init__(self, config_file, simple_layout, gen_graph):
+    hash_re = re.compile(r"^[0-9a-f]{64}$")
+
+    def __init__(
+            self,
+            config_file,
+            simple_layout,
+            gen_graph,
+            verify=False,
+            full=False,
+            dry_run=False,
+            plan_file=None,
+            fetch_only=False,
+            shard=None
+    ):
         self.logger.debug("Loading configuration: %s", config_file)
         with open(config_file, 'rt') as fp:
             data = json.load(fp)
-        self._connector = PypiConnector(data["endpoint"])
+        self._destination_folder = os.path.abspath(data["destination_folder"])
+        cache_config = {}
+        if "cache" in data and data["cache"]:
+            cache_config = data["cache"]
+        metadata_config = {}
+        if "metadata" in data and data["metadata"]:
+            metadata_config = data["metadata"]
+        xmlrpc_config = {}
+        if "xmlrpc" in data and data["xmlrpc"]:
+            xmlrpc_config = data["xmlrpc"]
+        self._policy = pypisync.RequestPolicy.from_config(data.get("requests"))
+        self._connector = PypiConnector(
+            data["endpoint"],
+            cache_config.get("file", os.path.join(self._destination_folder, ".pypisync", "project_info.sqlite")),
+            cache_config.get("max_entries"),
+            metadata_config.get("max_in_flight"),
+            self._policy,
+            xmlrpc_config.get("multicall_chunk_size")
+        )
         self._simplified_dependencies = {}
         self._in_packages_list = data["packages"]
         self._environment = None
         if "environment" in data:
             self._environment = data["environment"]
-        self._destination_folder = os.path.abspath(data["destination_folder"])
         self._downloaded = set()
         self._arch_exclude = None
         if "arch_exclude" in data:
             self._arch_exclude = data["arch_exclude"]
 
         self._packages_re = None
+        self._packages_filter = None
         if "packages_re" in data and data["packages_re"]:
             self._packages_re = data["packages_re"]
+            self._packages_filter = pypisync.ProjectNameFilter(self._packages_re)
         self._simple_layout = simple_layout
         self._gen_graph = gen_graph
+        self._verify = verify
+        self._full = full
+        self._dry_run = dry_run
+        self._fetch_only = fetch_only
+        self._plan_file = plan_file
+        if self._plan_file is None and shard is None:
+            self._plan_file = os.path.join(self._destination_folder, ".pypisync", "plan.jsonl")
+        self._state = None
+        self._config_fingerprint = pypisync.SyncState.fingerprint(
+            [
+                data["endpoint"],
+                self._in_packages_list,
+                self._packages_re,
+                self._environment,
+                self._arch_exclude,
+                self._simple_layout
+            ]
+        )
 
-    @staticmethod
-    def _version_match(wanted, current):
-        try:
-            wanted = packaging.specifiers.SpecifierSet(wanted)
-            current = packaging.version.Version(current)
-            result = current in wanted
-        except packaging.specifiers.InvalidSpecifier:
-            wanted = packaging.version.Version(wanted)
-            current = packaging.version.Version(current)
-            result = current == wanted
-        except packaging.version.InvalidVersion:
-            # Bad version. don't download it
-            result = False
-        return result
+        store_config = {}
+        if "store" in data and data["store"]:
+            store_config = data["store"]
+        store_folder = store_config.get("folder", os.path.join(self._destination_folder, ".pypisync", "blobs"))
+        pypisync.PypiPackage.set_store(None if store_folder is None else pypisync.BlobStore(store_folder))
 
-    def _latest_version(self, package, arch_exclude, n=1, spec=None):
-        all_versions_str = set()
-        for project in self._connector.get_project_info(package, arch_exclude):
-            if spec is not None:
-                if not self._version_match(spec, project.version):
-                    continue
-            all_versions_str.add(project.version)
+        file_index_config = {}
+        if "file_index" in data and data["file_index"]:
+            file_index_config = data["file_index"]
+        self._file_index = pypisync.FileIndex(
+            file_index_config.get("file", os.path.join(self._destination_folder, ".pypisync", "file_index.sqlite")),
+            file_index_config.get("scan_workers")
+        )
+        pypisync.PypiPackage.set_file_index(self._file_index)
 
-        all_versions = []
-        for version_str in all_versions_str:
-            try:
-                all_versions.append(packaging.version.Version(version_str))
-            except packaging.version.InvalidVersion:
-                # Ignore them...
-                pass
+        dependency_store_config = {}
+        if "dependency_store" in data and data["dependency_store"]:
+            dependency_store_config = data["dependency_store"]
+        pypisync.PypiPackage.set_dependency_store(
+            pypisync.DependencyStore(
+                dependency_store_config.get(
+                    "file",
+                    os.path.join(self._destination_folder, ".pypisync", "dependencies.sqlite")
+                ),
+                pypisync.SyncState.fingerprint(self._environment)
+            )
+        )
+
+        metrics_config = {}
+        if "metrics" in data and data["metrics"]:
+            metrics_config = data["metrics"]
+        self._metrics_file = metrics_config.get(
+            "file",
+            os.path.join(self._destination_folder, ".pypisync", "metrics.json")
+        )
+        self._prometheus_file = metrics_config.get("prometheus_file")
+        self._metrics = pypisync.SyncMetrics()
+        self._planned_files = 0
+
+        shards_config = {}
+        if "shards" in data and data["shards"]:
+            shards_config = data["shards"]
+        self._shards_folder = shards_config.get("folder", os.path.join(self._destination_folder, ".pypisync", "shards"))
+        self._shards_poll_interval = shards_config.get("poll_interval")
+        self._shard = None
+        self._shard_index = None
+        if shard is not None:
+            self._shard_index = pypisync.ShardCoordinator.parse(shard)
 
-        all_versions = sorted(all_versions)
-        if not all_versions:
+        serve_config = {}
+        if "serve" in data and data["serve"]:
+            serve_config = data["serve"]
+        self._project_ttl = serve_config.get("project_ttl")
+
+        download_config = {}
+        if "download" in data and data["download"]:
+            download_config = data["download"]
+        self._scheduler = pypisync.DownloadScheduler(
+            download_config.get("workers"),
+            download_config.get("per_host"),
+            download_config.get("queue_size")
+        )
+        self._download_order = download_config.get("order", "plan")
+        if self._download_order not in pypisync.SyncPlan.orders:
+            raise ValueError("Unknown download order %r" % self._download_order)
+        bandwidth = pypisync.BandwidthLimiter(
+            download_config.get("max_bytes_per_second"),
+            download_config.get("bandwidth_windows")
+        )
+        pypisync.PypiPackage.set_downloader(
+            pypisync.HttpDownloader(
+                download_config.get("workers") or pypisync.DownloadScheduler.default_workers,
+                download_config.get("chunk_size"),
+                policy=self._policy,
+                bandwidth=bandwidth if bandwidth.limited else None
+            )
+        )
+
+    def _latest_version(self, package, arch_exclude, n=1, spec=None):
+        latest = self._connector.get_project_versions(package, arch_exclude).latest(n, spec)
+        if latest is None:
             return None
-        while len(all_versions) < n:
-            n -= 1
         if spec is None:
-            return ">=%s" % all_versions[-n]
+            return ">=%s" % latest
         else:
-            return ">=%s,%s" % (all_versions[-n], spec)
+            return ">=%s,%s" % (latest, spec)
 
-    @staticmethod
-    def _keep_latest(packages):
-        all_versions = []
-        for project in packages:
-            if not project.yanked:
-                all_versions.append(packaging.version.Version(project.version))
-        all_versions = sorted(set(all_versions))
-        if all_versions:
-            latest_version = all_versions[-1]
-            for project in packages:
-                if packaging.version.Version(project.version) == latest_version:
-                    yield project
-
-    def packages(self, packages, latest_only=False):
+    def packages(self, packages, latest_only=False, prefetch=True):
         ref_latest_re = re.compile("^(?P<n>[0-9]+)? *latest(?P<spec>.*)?$")
-        for package in packages:
+        if prefetch:
+            # The projects are fetched concurrently, and each one is matched as soon as its information arrives
+            names = self._connector.prefetch_project_info(packages)
+        else:
+            # Already fetched by the caller
+            names = packages
+        for package in names:
             wanted_versions = packages[package]
+            versions = self._connector.get_project_versions(package, self._arch_exclude)
 
             for wanted_version in wanted_versions:
                 if wanted_version == "latest":
@@ -188,21 +500,20 @@ class PypiSync:
                     )
                 if wanted_version is None:
                     continue
-                matched = []
-                for project in self._connector.get_project_info(package, self._arch_exclude):
-                    if self._version_match(wanted_version, project.version):
-                        matched.append(project)
+                matched = versions.matching(wanted_version)
                 if latest_only:
-                    matched = self._keep_latest(matched)
+                    matched = versions.keep_latest(matched)
 
-                for project_ in matched:
+                for project_ in versions.files(matched):
                     yield pypisync.PypiPackage(
                         project_.project,
                         project_.version,
                         project_.url,
                         self._destination_folder,
                         self._simple_layout,
-                        self._environment
+                        self._environment,
+                        size=project_.size,
+                        yanked=project_.yanked
                     )
 
     @staticmethod
@@ -214,64 +525,406 @@ class PypiSync:
             os.path.basename(package.file_basename)
         )
         package.download()
-        return package, package.dependencies()
+        return package, True
 
-    def _download(self, packages):
-        results = []
-        all_dependencies = set()
+    @staticmethod
+    def _resolve_package(package, allow_download):
+        """
+        Get the dependencies of a package, downloading it only when its metadata cannot be read remotely
+        :param allow_download: if False, the dependencies of such packages are ignored
+        :return: the package and its dependencies
+        """
+        dependencies = package.dependencies()
+        if dependencies is None:
+            if not allow_download:
+                PypiSync.logger.warning(
+                    "The dependencies of %s cannot be known without downloading it",
+                    package.file_basename
+                )
+                return package, {}
+            PypiSync._download_package(package)
+            dependencies = package.dependencies()
+        return package, dependencies
+
+    def _schedule_resolution(self, packages, scheduled, pending):
+        """
+        Submit the packages that were not already seen for resolution
+        :param packages: an iterable of PypiPackage. Consumed lazily so that the resolution starts while it is produced
+        :param scheduled: the set of packages already submitted
+        :param pending: the set of futures to update
+        """
         for package in packages:
-            if package in self._downloaded:
+            if package in scheduled:
                 continue
-            # submit packages for downloading
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                results.append(
-                    executor.submit(
-                        self._download_package,
-                        package
-                    )
-                )
+            scheduled.add(package)
+            pending.add(self._scheduler.submit(package.url, self._resolve_package, package, not self._dry_run))
 
-        # retrieve the dependencies
-        for result in results:
-            package, dependencies = result.result()
-            packages_dependencies = set(self.packages(dependencies, True))
-            all_dependencies.update(packages_dependencies)
-            self._downloaded.add(package)
-
-            simplified = pypisync.PypiPackage(pypi_simple.normalize(package.name), package.version)
-            if simplified not in self._simplified_dependencies:
-                self._simplified_dependencies[simplified] = set()
-            for dependency in packages_dependencies:
-                self._simplified_dependencies[simplified].add(
-                    pypisync.PypiPackage(pypi_simple.normalize(dependency.name), dependency.version)
-                )
+    def plan(self, packages):
+        """
+        Build the full closure of files to fetch
+        :param packages: an iterable of PypiPackage
+        :return: a SyncPlan
+        """
+        plan = pypisync.SyncPlan()
+        scheduled = set()
+        pending = set()
+        self._schedule_resolution(packages, scheduled, pending)
 
-        if all_dependencies:
-            self._download(all_dependencies)
+        # expand the dependencies as soon as they are known
+        while True:
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                resolved = [result.result() for result in done]
+                if self._shard is not None:
+                    # The dependencies owned by the other shards are resolved by their node
+                    discovered = {}
+                    for _, dependencies in resolved:
+                        for name, specs in dependencies.items():
+                            discovered.setdefault(name, set()).update(specs)
+                    self._shard.hand_off(discovered)
+                    resolved = [
+                        (package, dict((name, specs) for name, specs in dependencies.items() if self._shard.owns(name)))
+                        for package, dependencies in resolved
+                    ]
+                # Fetch the information of all the newly known dependencies together
+                for _ in self._connector.prefetch_project_info(
+                        name
+                        for _, dependencies in resolved
+                        for name in dependencies
+                ):
+                    pass
+                for package, dependencies in resolved:
+                    packages_dependencies = set(self.packages(dependencies, True, False))
+                    for dependency in packages_dependencies:
+                        self._state.add_dependency(package.name, dependency.name)
+                    plan.add(package, packages_dependencies)
+                    self._schedule_resolution(packages_dependencies, scheduled, pending)
+            if self._shard is None:
+                return plan
+            # Resolve the dependencies handed off by the other nodes, until they are all done
+            handed_off = self._shard.wait_for_work()
+            if handed_off is None:
+                return plan
+            self._schedule_resolution(self.packages(handed_off, True), scheduled, pending)
 
-    def run(self):
-        self._downloaded = set()
+    def fetch(self, plan):
+        """
+        Download all the files of a plan
+        :param plan: a SyncPlan
+        """
+        pending = set()
+        for package in plan.ordered(self._download_order):
+            pending.add(self._scheduler.submit(package.url, self._download_package, package))
+
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for result in done:
+                package, _ = result.result()
+                self._downloaded.add(package)
+
+    def _recorded_hash(self, path, planned):
+        """
+        :param planned: the packages of the last plan, by local file
+        :return: the sha256 path is expected to have, None if it is not known
+        """
+        parts = os.path.relpath(path, self._destination_folder).split(os.sep)
+        if len(parts) == 5 and parts[0] == "packages" and self.hash_re.fullmatch("".join(parts[1:4])):
+            return "".join(parts[1:4])
+        if path in planned:
+            return planned[path].file_hash
+        entry = self._file_index.get(path)
+        return None if entry is None else entry[2]
+
+    @staticmethod
+    def _check_file(path, expected):
+        """
+        :return: path, and True if its content matches expected
+        """
+        return path, pypisync.HttpDownloader.hash_file(path).hexdigest() == expected
+
+    def _remove_corrupted(self, path, expected):
+        """
+        Remove a corrupted file, and its blob if the blob is corrupted too (it is usually the same file)
+        """
+        self.logger.warning("Corrupted file %s, removing it", path)
+        os.unlink(path)
+        self._file_index.forget(path)
+        store = pypisync.PypiPackage.get_store()
+        if store is not None and expected in store:
+            if pypisync.HttpDownloader.hash_file(store.path(expected)).hexdigest() != expected:
+                store.discard(expected)
+
+    def verify(self):
+        """
+        Check the files of the destination folder against their recorded sha256, without asking upstream.
+        A file of the simple layout must match the sha256 in its path, the other ones the sha256 of the last plan, else
+        the one of the file index. The corrupted files are removed. The ones of the last plan, and its missing files,
+        are then downloaded again. The other ones are downloaded by the next sync, which examines everything.
+        :return: 0 if all the files are intact or repaired
+        """
+        planned = {}
+        if self._plan_file is not None and os.path.exists(self._plan_file):
+            for package in pypisync.SyncPlan.read(
+                    self._plan_file,
+                    self._destination_folder,
+                    self._simple_layout,
+                    self._environment
+            ):
+                planned[package.local_file] = package
+        simple_root = os.path.join(self._destination_folder, "simple") + os.sep
+        found = set()
+        corrupted = []
+        unknown = 0
+        self.logger.info("Verifying the files of %s", self._destination_folder)
+        with self._scheduler:
+            pending = set()
+            with self._metrics.timer("verify"):
+                for path, _, _ in self._file_index.walk(self._destination_folder):
+                    if path.startswith(simple_root):
+                        # The generated index
+                        continue
+                    found.add(path)
+                    expected = self._recorded_hash(path, planned)
+                    if expected is None:
+                        unknown += 1
+                        continue
+                    # Hashing is local work, not limited per host
+                    pending.add(self._scheduler.submit(None, self._check_file, path, expected))
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for result in done:
+                        path, intact = result.result()
+                        if not intact:
+                            self._remove_corrupted(path, self._recorded_hash(path, planned))
+                            corrupted.append(path)
+            missing = [package for local_file, package in planned.items() if local_file not in found]
+            repair = [planned[path] for path in corrupted if path in planned] + missing
+            for package in repair:
+                pending.add(self._scheduler.submit(package.url, self._download_package, package))
+            failed = 0
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for result in done:
+                    if result.exception() is not None:
+                        self.logger.error("Cannot download again: %s", result.exception())
+                        failed += 1
+        self.logger.info(
+            "Verified %d files: %d corrupted, %d missing from the plan, %d downloaded again. "
+            "%d files of unknown sha256 not checked",
+            len(found) - unknown,
+            len(corrupted),
+            len(missing),
+            len(repair) - failed,
+            unknown
+        )
+        self._metrics.increment("verified_files", len(found) - unknown)
+        self._metrics.increment("corrupted_files", len(corrupted))
+        lost = len(corrupted) - len([path for path in corrupted if path in planned])
+        if lost:
+            # An incremental sync would not examine their projects again
+            state = pypisync.SyncState(self._state_file)
+            state.serial = None
+            state.save()
+            self.logger.warning(
+                "%d corrupted files are not in the last plan, the next sync examines everything to download them again",
+                lost
+            )
+        return 1 if failed or lost else 0
+
+    @property
+    def _state_file(self):
+        return os.path.join(self._destination_folder, ".pypisync", "state.json")
+
+    def _changed_projects(self):
+        """
+        :return: the names of the projects to examine again since the previous run, None to examine everything
+        """
+        if self._full:
+            return None
+        if self._shard is not None:
+            # The state is not shared by the nodes
+            self.logger.info("Sharded sync, syncing everything")
+            return None
+        if self._state.serial is None or self._state.config_fingerprint != self._config_fingerprint:
+            self.logger.info("No previous sync with this configuration, syncing everything")
+            return None
+        changed = self._connector.get_changed_projects(self._state.serial)
+        self.logger.info("%d projects changed since serial %d", len(changed), self._state.serial)
+        return self._state.affected(changed)
+
+    def _initial_packages(self, serial):
+        """
+        :param serial: the current upstream serial, None if unknown
+        :return: the configured packages, restricted to the ones that changed since the previous run if possible
+        """
         this_package_list = {}
-        self._simplified_dependencies = {}
+        changed = None
+        if serial is not None:
+            changed = self._changed_projects()
+
         if self._packages_re is not None:
-            # build a primary package list from the simple index
-            self.logger.info("Getting the packages list (might take some time...)")
-            for package in tqdm(self._connector.get_projects_names(), desc="Filtering", unit=" packages"):
-                for packages_re_str in self._packages_re:
-                    packages_re = re.compile(packages_re_str)
-                    if packages_re.match(package):
-                        if package not in this_package_list:
-                            this_package_list[package] = []
-                        this_package_list[package] += self._packages_re[packages_re_str]
-        this_package_list.update(self._in_packages_list)
-        self._download(self.packages(this_package_list))
+            if changed is None:
+                # build a primary package list from the simple index
+                self.logger.info("Getting the packages list (might take some time...)")
+                projects_names = self._connector.get_projects_names()
+            else:
+                projects_names = sorted(changed)
+            for package, specs in self._packages_filter.filter(
+                    tqdm(projects_names, desc="Filtering", unit=" packages")
+            ):
+                this_package_list[package] = specs
+        if changed is None:
+            this_package_list.update(self._in_packages_list)
+        else:
+            changed = set(pypi_simple.normalize(x) for x in changed)
+            for package in self._in_packages_list:
+                if pypi_simple.normalize(package) in changed:
+                    this_package_list[package] = self._in_packages_list[package]
+        if self._shard is not None:
+            this_package_list = dict(
+                (package, specs) for package, specs in this_package_list.items() if self._shard.owns(package)
+            )
+        return this_package_list
 
+    def serve(self, host, port):
+        """
+        Serve the destination folder as a pull-through cache of upstream, until interrupted. See CachingProxy
+        """
+        proxy = pypisync.CachingProxy(
+            self._connector,
+            self._destination_folder,
+            (host, port),
+            self._arch_exclude,
+            self._project_ttl
+        )
+        try:
+            proxy.serve_forever()
+        except KeyboardInterrupt:
+            self.logger.info("Interrupted")
+        finally:
+            proxy.stop()
+        return 0
+
+    def run(self):
+        self._metrics = pypisync.SyncMetrics()
+        pypisync.SyncMetrics.set_current(self._metrics)
+        try:
+            with self._metrics.timer("run"):
+                if self._verify:
+                    return self.verify()
+                return self._run()
+        finally:
+            self._write_metrics()
+
+    def merge_shards(self):
+        """
+        Build the simple index of the files of all the shards, once all their nodes are done
+        """
+        plan_files = pypisync.ShardCoordinator.plan_files(self._shards_folder)
+        if plan_files is None:
+            self.logger.error("No complete shard run in %s", self._shards_folder)
+            return 1
+        packages = []
+        for plan_file in plan_files:
+            self.logger.info("Reading the plan %s", plan_file)
+            packages.extend(
+                pypisync.SyncPlan.read(plan_file, self._destination_folder, self._simple_layout, self._environment)
+            )
         if self._simple_layout:
-            generator = pypisync.SimpleIndexGenerator(os.path.join(self._destination_folder, "simple"))
-            generator.generate(self._downloaded)
+            generator = pypisync.SimpleIndexGenerator(
+                os.path.join(self._destination_folder, "simple"),
+                os.path.join(self._destination_folder, ".pypisync", "simple_manifest.sqlite")
+            )
+            written = generator.generate(packages)
+            generator.close()
+            self.logger.info("Simple index: %d pages written for %d files", written, len(packages))
+        pypisync.ShardCoordinator.clear(self._shards_folder)
+        return 0
+
+    def _write_metrics(self):
+        self._metrics.increment("planned_files", self._planned_files)
+        self._metrics.increment("synced_files", len(self._downloaded))
+        if self._metrics_file is not None:
+            self._metrics.write_json(self._metrics_file)
+            self.logger.info("Metrics written to %s", self._metrics_file)
+        if self._prometheus_file is not None:
+            self._metrics.write_prometheus(self._prometheus_file)
+
+    def _run(self):
+        self._downloaded = set()
+        self._planned_files = 0
+        self._state = pypisync.SyncState(self._state_file)
+        self._shard = None
+        if self._shard_index is not None and not self._fetch_only:
+            self._shard = pypisync.ShardCoordinator(
+                self._shards_folder,
+                self._shard_index[0],
+                self._shard_index[1],
+                self._shards_poll_interval
+            )
+        plan_file = self._plan_file
+        if plan_file is None:
+            # Named after the run of the shards
+            if self._shard is not None:
+                plan_file = self._shard.plan_file()
+            else:
+                plan_file = pypisync.ShardCoordinator.run_plan_file(self._shards_folder, self._shard_index[0])
+                if plan_file is None:
+                    self.logger.error("No shard run in %s", self._shards_folder)
+                    return 1
+        serial = None
+        with self._scheduler:
+            if self._fetch_only:
+                self.logger.info("Reading the plan %s", plan_file)
+                plan = pypisync.SyncPlan.read(
+                    plan_file,
+                    self._destination_folder,
+                    self._simple_layout,
+                    self._environment
+                )
+            else:
+                # Taken before listing, so that changes made during the sync are processed by the next one
+                serial = self._connector.get_last_serial()
+                with self._metrics.timer("plan"):
+                    plan = self.plan(self.packages(self._initial_packages(serial)))
+                plan.write(plan_file)
+            self._planned_files = len(plan)
+            self.logger.info(
+                "Plan: %d files, %d bytes (%.2f GiB)%s",
+                len(plan),
+                plan.total_size,
+                plan.total_size / 1024 ** 3,
+                " + %d files of unknown size" % plan.unknown_sizes if plan.unknown_sizes else ""
+            )
+            if self._dry_run:
+                return 0
+            if len(self._file_index) == 0 and os.path.isdir(self._destination_folder):
+                self.logger.info("Indexing the files of %s", self._destination_folder)
+                with self._metrics.timer("file_index_scan"):
+                    indexed = self._file_index.scan(self._destination_folder)
+                self.logger.info("%d files indexed", indexed)
+            with self._metrics.timer("fetch"):
+                self.fetch(plan)
+        if self._shard_index is not None:
+            self.logger.info("Shard %d/%d done, the index is built by --merge-shards", *self._shard_index)
+        elif self._simple_layout:
+            generator = pypisync.SimpleIndexGenerator(
+                os.path.join(self._destination_folder, "simple"),
+                os.path.join(self._destination_folder, ".pypisync", "simple_manifest.sqlite")
+            )
+            with self._metrics.timer("index_generation"):
+                written = generator.generate(self._downloaded)
+            generator.close()
+            self.logger.info("Simple index: %d pages written", written)
+
+        if serial is not None and self._shard_index is None:
+            self._state.serial = serial
+            self._state.config_fingerprint = self._config_fingerprint
+            self._state.save()
 
         # Generate dependencies tree.
         if self._gen_graph:
+            self._simplified_dependencies = plan.simplified_dependencies()
             self.logger.info("Generating dependency graph")
             with open('./graph.dot', 'w') as out:
                 for line in ('digraph G {',):
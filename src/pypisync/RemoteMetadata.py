@@ -0,0 +1,171 @@
+import io
+import logging
+import os
+import re
+import urllib.parse
+import zipfile
+import pkginfo
+
+import pypisync
+
+
+class RangeNotSupported(Exception):
+    """
+    The server does not answer to Range requests
+    """
+
+
+class HttpRangeFile(io.RawIOBase):
+    """
+    Read only, seekable file object over http Range requests.
+    Each request reads at least block_size bytes, the blocks are kept so that zipfile can seek around the central
+    directory without a request per read.
+    """
+
+    block_size = 64 * 1024
+
+    def __init__(self, session, url, timeout=None, policy=None):
+        super().__init__()
+        self._session = session
+        self._policy = policy or pypisync.RequestPolicy()
+        self._url = url
+        self._timeout = timeout
+        self._position = 0
+        self._blocks = {}
+        self._size = None
+        # The last bytes contain the zip end of central directory: start with them, it also gives the size
+        self._fetch(-self.block_size)
+
+    def _fetch(self, start, end=None):
+        """
+        Fetch [start, end[ or the last -start bytes if start is negative
+        """
+        if start < 0:
+            byte_range = "bytes=%d" % start
+        else:
+            byte_range = "bytes=%d-%d" % (start, end - 1)
+        response = self._policy.call(
+            self._url,
+            self._session.get,
+            self._url,
+            headers={"Range": byte_range, "Accept-Encoding": "identity"},
+            stream=True,
+            timeout=self._timeout
+        )
+        with response:
+            if response.status_code != 206:
+                raise RangeNotSupported("%s answered %d to a Range request" % (self._url, response.status_code))
+            content_range = re.match(r"bytes (\d+)-(\d+)/(\d+)", response.headers.get("Content-Range", ""))
+            if content_range is None:
+                raise RangeNotSupported("%s did not send a Content-Range" % self._url)
+            self._size = int(content_range.group(3))
+            self._blocks[int(content_range.group(1))] = response.content
+
+    def _find_block(self, position):
+        for start, data in self._blocks.items():
+            if start <= position < start + len(data):
+                return start, data
+        return None, None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self._size + offset
+        else:
+            raise ValueError("Invalid whence: %r" % whence)
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._position
+        size = min(size, self._size - self._position)
+        result = b""
+        while size > 0:
+            start, data = self._find_block(self._position)
+            if data is None:
+                self._fetch(self._position, min(self._position + max(size, self.block_size), self._size))
+                continue
+            chunk = data[self._position - start:self._position - start + size]
+            result += chunk
+            self._position += len(chunk)
+            size -= len(chunk)
+        return result
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class RemoteMetadata:
+    """
+    Get the core metadata of a distribution without downloading it:
+      * from the PEP 658 ".metadata" file next to the distribution when upstream provides it
+      * else, for wheels, by reading the zip central directory and the METADATA member with Range requests
+    """
+    logger = logging.getLogger(__name__)
+
+    metadata_suffix = ".metadata"
+
+    def __init__(self, session, timeout=60, policy=None):
+        """
+        :param session: the requests.Session to use
+        :param timeout: connect and read timeout, in seconds
+        :param policy: the pypisync.RequestPolicy of the requests
+        """
+        self._session = session
+        self._timeout = timeout
+        self._policy = policy or pypisync.RequestPolicy()
+
+    @staticmethod
+    def _parse(data):
+        metadata = pkginfo.Distribution()
+        metadata.parse(data)
+        return metadata
+
+    def _fetch_metadata_file(self, url):
+        response = self._policy.call(
+            url,
+            self._session.get,
+            url + self.metadata_suffix,
+            timeout=self._timeout
+        )
+        if response.status_code != 200:
+            return None
+        return response.content
+
+    def _fetch_from_wheel(self, url):
+        with zipfile.ZipFile(HttpRangeFile(self._session, url, self._timeout, self._policy)) as wheel:
+            for name in wheel.namelist():
+                tokens = name.split("/")
+                if len(tokens) == 2 and tokens[0].endswith(".dist-info") and tokens[1] == "METADATA":
+                    return wheel.read(name)
+        return None
+
+    def fetch(self, url):
+        """
+        :param url: the url of the distribution
+        :return: a pkginfo.Distribution, or None if the metadata cannot be read without downloading the file
+        """
+        url = urllib.parse.urldefrag(url)[0]
+        data = self._fetch_metadata_file(url)
+        if data is None and os.path.basename(urllib.parse.urlparse(url).path).endswith(".whl"):
+            try:
+                data = self._fetch_from_wheel(url)
+            except (RangeNotSupported, zipfile.BadZipFile) as e:
+                self.logger.debug("Cannot read the metadata of %s remotely: %s", url, e)
+        if data is None:
+            return None
+        return self._parse(data)
@@ -0,0 +1,229 @@
+import email.utils
+import http.client
+import logging
+import random
+import socket
+import threading
+import time
+import urllib.parse
+import xmlrpc.client
+import requests
+
+
+class RetryableError(Exception):
+    """
+    Upstream answered with a status worth trying again
+    """
+    def __init__(self, url, status, retry_after=None):
+        super().__init__("%s answered %d" % (url, status))
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _HostState:
+    """
+    Token bucket and circuit breaker of a host
+    """
+
+    def __init__(self, burst):
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.failures = 0
+        self.open_until = 0.0
+
+
+class RequestPolicy:
+    """
+    Retries, backoff and rate limiting shared by all the requests to upstream (JSON API, downloads and XML-RPC).
+
+    For each host:
+      * a token bucket limits the request rate, allowing bursts
+      * after circuit_failures consecutive failures, the circuit opens: no request is sent to the host for
+        circuit_cooldown seconds
+    A failed request is retried up to retries times, after an exponential backoff with full jitter, or after the delay
+    given by a Retry-After header when it is longer.
+    """
+    logger = logging.getLogger(__name__)
+
+    retry_statuses = (408, 425, 429, 500, 502, 503, 504)
+    retry_exceptions = (
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+        http.client.HTTPException,
+        # Socket errors of the XML-RPC transport
+        ConnectionError,
+        TimeoutError,
+        socket.gaierror,
+    )
+
+    default_retries = 5
+    default_backoff = 1.0
+    default_max_backoff = 60.0
+    default_circuit_failures = 10
+    default_circuit_cooldown = 30.0
+
+    def __init__(
+            self,
+            rate=None,
+            burst=None,
+            retries=None,
+            backoff=None,
+            max_backoff=None,
+            circuit_failures=None,
+            circuit_cooldown=None
+    ):
+        """
+        :param rate: the maximum number of requests per second to a host. None for no limit
+        :param burst: the number of requests that can be sent at once before being limited. Defaults to rate, and is
+                      at least 1 so that a request can always be sent
+        :param retries: the number of retries of a failed request
+        :param backoff: the base delay of the exponential backoff, in seconds
+        :param max_backoff: the maximum delay between two tries, in seconds
+        :param circuit_failures: the number of consecutive failures opening the circuit of a host
+        :param circuit_cooldown: how long an open circuit stays open, in seconds
+        """
+        self._rate = rate
+        self._burst = max(1, burst or rate or 1)
+        self._retries = self.default_retries if retries is None else retries
+        self._backoff = self.default_backoff if backoff is None else backoff
+        self._max_backoff = self.default_max_backoff if max_backoff is None else max_backoff
+        self._circuit_failures = circuit_failures or self.default_circuit_failures
+        self._circuit_cooldown = self.default_circuit_cooldown if circuit_cooldown is None else circuit_cooldown
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: the "requests" configuration, None for the defaults
+        """
+        config = config or {}
+        return cls(
+            config.get("rate"),
+            config.get("burst"),
+            config.get("retries"),
+            config.get("backoff"),
+            config.get("max_backoff"),
+            config.get("circuit_failures"),
+            config.get("circuit_cooldown")
+        )
+
+    def _host_state(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = _HostState(self._burst)
+            return self._hosts[host]
+
+    @staticmethod
+    def _wait_circuit(state):
+        with state.lock:
+            delay = state.open_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _acquire_token(self, state):
+        if self._rate is None:
+            return
+        while True:
+            with state.lock:
+                now = time.monotonic()
+                state.tokens = min(self._burst, state.tokens + (now - state.updated) * self._rate)
+                state.updated = now
+                if state.tokens >= 1:
+                    state.tokens -= 1
+                    return
+                delay = (1 - state.tokens) / self._rate
+            time.sleep(delay)
+
+    def _success(self, state):
+        with state.lock:
+            state.failures = 0
+            state.open_until = 0.0
+
+    def _failure(self, state, url):
+        with state.lock:
+            state.failures += 1
+            if state.failures >= self._circuit_failures:
+                self.logger.warning(
+                    "%d consecutive failures on %s, pausing it for %.0fs",
+                    state.failures,
+                    urllib.parse.urlparse(url).netloc,
+                    self._circuit_cooldown
+                )
+                state.open_until = time.monotonic() + self._circuit_cooldown
+                state.failures = 0
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        :param value: a Retry-After header, in seconds or as a http date
+        :return: the delay in seconds, None if not understood
+        """
+        if value is None:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, date.timestamp() - time.time())
+
+    def _retryable(self, error):
+        """
+        :return: (True, the Retry-After delay) if error is worth retrying
+        """
+        if isinstance(error, RetryableError):
+            return True, error.retry_after
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            if error.response.status_code in self.retry_statuses:
+                return True, self.parse_retry_after(error.response.headers.get("Retry-After"))
+            return False, None
+        if isinstance(error, xmlrpc.client.ProtocolError):
+            if error.errcode in self.retry_statuses:
+                return True, self.parse_retry_after((error.headers or {}).get("Retry-After"))
+            return False, None
+        return isinstance(error, self.retry_exceptions), None
+
+    def _delay(self, attempt, retry_after):
+        delay = random.uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self._max_backoff))
+        return delay
+
+    def call(self, url, function, *args, **kwargs):
+        """
+        Call function with the policy of the host of url.
+        Retryable failures are exceptions, or requests.Response with a retryable status (closed before trying again).
+        :return: the result of function
+        """
+        state = self._host_state(url)
+        attempt = 0
+        while True:
+            self._wait_circuit(state)
+            self._acquire_token(state)
+            try:
+                result = function(*args, **kwargs)
+                if isinstance(result, requests.Response) and result.status_code in self.retry_statuses:
+                    retry_after = self.parse_retry_after(result.headers.get("Retry-After"))
+                    result.close()
+                    raise RetryableError(url, result.status_code, retry_after)
+            except Exception as e:
+                retryable, retry_after = self._retryable(e)
+                if not retryable:
+                    raise
+                self._failure(state, url)
+                if attempt >= self._retries:
+                    raise
+                delay = self._delay(attempt, retry_after)
+                attempt += 1
+                self.logger.info("%s failed (%s), try %d in %.1fs", url, e, attempt + 1, delay)
+                time.sleep(delay)
+                continue
+            self._success(state)
+            return result
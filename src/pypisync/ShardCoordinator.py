@@ -0,0 +1,308 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+import pypi_simple
+
+
+class ShardCoordinator:
+    """
+    Coordination of the nodes of a sharded sync, through a folder shared by all of them.
+
+    The projects are split in shards by a hash of their normalized name. Node i resolves and fetches the projects of
+    shard i, and hands the dependencies owned by the other shards to their node, in a queue file per (sender, receiver)
+    so that each file has a single writer.
+
+    Each node publishes its status: whether it is idle, and how many messages it sent to and received from each node.
+    The sync is over when all the nodes are idle and every message sent was received, twice in a row.
+
+    The files of a previous run that was interrupted or not merged must not be taken for current ones: node 0 clears
+    the folder and starts a run, with a new id. The other nodes ask to join it with a nonce, and start once node 0
+    acknowledged it. The statuses, the queues and the plans are named after the run id.
+    """
+    logger = logging.getLogger(__name__)
+
+    default_poll_interval = 1.0
+    shard_re = re.compile(r"^(?P<index>[0-9]+)/(?P<count>[0-9]+)$")
+
+    def __init__(self, folder, index, count, poll_interval=None):
+        """
+        :param folder: the folder shared by the nodes
+        :param index: the shard of this node, from 0 to count - 1
+        :param count: the number of shards
+        :param poll_interval: the delay between two looks at the queues when idle, in seconds
+        """
+        if not 0 <= index < count:
+            raise ValueError("Invalid shard %d/%d" % (index, count))
+        self._folder = folder
+        self._index = index
+        self._count = count
+        self._poll_interval = self.default_poll_interval if poll_interval is None else poll_interval
+        self._sent = [0] * count
+        self._received = [0] * count
+        self._offsets = [0] * count
+        self._idle = False
+        self._handed_off = set()
+        # The nonce of the nodes that joined the run, on node 0
+        self._members = {}
+        os.makedirs(self._folder, exist_ok=True)
+        if self._index == 0:
+            self._run = self._start_run()
+        else:
+            self._run = self._join_run()
+        self._write_status()
+
+    @staticmethod
+    def _write_json(filename, data):
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wt") as fp:
+            json.dump(data, fp)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def _read_json(filename):
+        """
+        :return: the content of a file written by _write_json, None if it does not exist
+        """
+        try:
+            with open(filename, "rt") as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _run_file(folder):
+        return os.path.join(folder, "run.json")
+
+    def _join_file(self, index):
+        return os.path.join(self._folder, "join-%d.json" % index)
+
+    def _start_run(self):
+        """
+        Clear what a previous run left, and start a new one
+        :return: the id of the run
+        """
+        self.clear(self._folder)
+        run = uuid.uuid4().hex
+        self._write_json(self._run_file(self._folder), {"run": run, "count": self._count, "members": self._members})
+        self.logger.info("Shard run %s started", run)
+        return run
+
+    def _acknowledge(self):
+        """
+        Let the nodes that asked for it join the run, on node 0
+        """
+        if self._index != 0:
+            return
+        changed = False
+        for index in range(1, self._count):
+            join = self._read_json(self._join_file(index))
+            if join is None or join["count"] != self._count or str(index) in self._members:
+                continue
+            self._members[str(index)] = join["nonce"]
+            changed = True
+        if changed:
+            self._write_json(
+                self._run_file(self._folder),
+                {"run": self._run, "count": self._count, "members": self._members}
+            )
+
+    def _join_run(self):
+        """
+        Wait until node 0 lets this node join its run
+        :return: the id of the run
+        """
+        nonce = uuid.uuid4().hex
+        while True:
+            # Written again when node 0 clears the folder after it was first written
+            join = self._read_json(self._join_file(self._index))
+            if join is None or join["nonce"] != nonce:
+                self._write_json(self._join_file(self._index), {"nonce": nonce, "count": self._count})
+            run = self._read_json(self._run_file(self._folder))
+            if run is not None and run["count"] == self._count and run["members"].get(str(self._index)) == nonce:
+                self.logger.info("Shard run %s joined", run["run"])
+                return run["run"]
+            time.sleep(self._poll_interval)
+
+    @classmethod
+    def parse(cls, shard):
+        """
+        :param shard: "i/N"
+        :return: (i, N)
+        """
+        match = cls.shard_re.fullmatch(shard)
+        if match is None:
+            raise ValueError("Invalid shard %r, expected i/N" % shard)
+        return int(match.group("index")), int(match.group("count"))
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def count(self):
+        return self._count
+
+    def owner(self, name):
+        """
+        :return: the shard of a project
+        """
+        digest = hashlib.sha256(pypi_simple.normalize(name).encode()).digest()
+        return int.from_bytes(digest[:8], "big") % self._count
+
+    def owns(self, name):
+        return self.owner(name) == self._index
+
+    @staticmethod
+    def _plan_file(folder, run, index):
+        return os.path.join(folder, "plan-%s-%d.jsonl" % (run, index))
+
+    def plan_file(self):
+        return self._plan_file(self._folder, self._run, self._index)
+
+    @classmethod
+    def run_plan_file(cls, folder, index):
+        """
+        :return: the plan of a node in the last run, None if there is no run
+        """
+        run = cls._read_json(cls._run_file(folder))
+        if run is None:
+            return None
+        return cls._plan_file(folder, run["run"], index)
+
+    @classmethod
+    def plan_files(cls, folder):
+        """
+        :return: the plans written by the nodes of the last run, None if one of them is missing
+        """
+        run = cls._read_json(cls._run_file(folder))
+        if run is None:
+            return None
+        plan_files = [cls._plan_file(folder, run["run"], index) for index in range(run["count"])]
+        missing = [x for x in plan_files if not os.path.exists(x)]
+        if missing:
+            cls.logger.error("The run %s is not complete, missing: %s", run["run"], ", ".join(missing))
+            return None
+        return plan_files
+
+    def _queue_file(self, sender, receiver):
+        return os.path.join(self._folder, "queue-%s-%d-to-%d.jsonl" % (self._run, sender, receiver))
+
+    def _status_file(self, index):
+        return os.path.join(self._folder, "status-%s-%d.json" % (self._run, index))
+
+    def _write_status(self):
+        self._write_json(
+            self._status_file(self._index),
+            {"idle": self._idle, "sent": self._sent, "received": self._received}
+        )
+
+    def hand_off(self, packages):
+        """
+        Send the packages owned by the other shards to their node. Each (name, version specifier) is only sent once
+        :param packages: same format as in the "packages" config file parameter
+        :return: the packages owned by this shard
+        """
+        own = {}
+        others = {}
+        for name, specs in packages.items():
+            owner = self.owner(name)
+            if owner == self._index:
+                own[name] = specs
+                continue
+            specs = sorted(x for x in specs if (name, x) not in self._handed_off)
+            if specs:
+                self._handed_off.update((name, x) for x in specs)
+                others.setdefault(owner, {})[name] = specs
+        for owner, message in others.items():
+            with open(self._queue_file(self._index, owner), "at") as fp:
+                fp.write(json.dumps(message, separators=(",", ":")))
+                fp.write("\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+            self._sent[owner] += 1
+        if others:
+            self._write_status()
+        self._acknowledge()
+        return own
+
+    def _receive(self):
+        """
+        Read the messages sent to this node since the previous call
+        :return: the packages to resolve, same format as in the "packages" config file parameter
+        """
+        packages = {}
+        received = False
+        for sender in range(self._count):
+            filename = self._queue_file(sender, self._index)
+            if not os.path.exists(filename):
+                continue
+            with open(filename, "rb") as fp:
+                fp.seek(self._offsets[sender])
+                for line in fp:
+                    if not line.endswith(b"\n"):
+                        # Still being written
+                        break
+                    self._offsets[sender] += len(line)
+                    self._received[sender] += 1
+                    received = True
+                    for name, specs in json.loads(line.decode()).items():
+                        packages.setdefault(name, set()).update(specs)
+        if received:
+            self._idle = False
+            self._write_status()
+        return packages
+
+    def _snapshot(self):
+        """
+        :return: the statuses of all the nodes, None if one of them did not start yet
+        """
+        statuses = []
+        for index in range(self._count):
+            status = self._read_json(self._status_file(index))
+            if status is None:
+                return None
+            statuses.append(status)
+        return statuses
+
+    def _finished(self, statuses):
+        if statuses is None or not all(status["idle"] for status in statuses):
+            return False
+        return all(
+            statuses[sender]["sent"][receiver] == statuses[receiver]["received"][sender]
+            for sender in range(self._count)
+            for receiver in range(self._count)
+        )
+
+    def wait_for_work(self):
+        """
+        Wait for packages handed off by the other nodes
+        :return: the packages to resolve, None when all the nodes are done
+        """
+        previous = None
+        while True:
+            packages = self._receive()
+            if packages:
+                return packages
+            if not self._idle:
+                self._idle = True
+                self._write_status()
+            self._acknowledge()
+            statuses = self._snapshot()
+            if self._finished(statuses) and statuses == previous:
+                return None
+            previous = statuses
+            time.sleep(self._poll_interval)
+
+    @staticmethod
+    def clear(folder):
+        """
+        Remove the plans, the queues, the statuses and the run, once the shards are merged or when a new run starts
+        """
+        for pattern in ("plan-*.jsonl", "queue-*-to-*.jsonl", "status-*.json", "join-*.json", "run.json"):
+            for filename in glob.glob(os.path.join(folder, pattern)):
+                os.unlink(filename)
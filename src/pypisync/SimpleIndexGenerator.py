@@ -1,10 +1,28 @@
+import gzip
+import hashlib
+import io
+import json
 import os
+import sqlite3
 import pypi_simple
+import packaging.version
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 class SimpleIndexGenerator:
     """
     Simple index generator
+
+    Each page is written in HTML (PEP 503) and in JSON (PEP 691), along with gzip (and brotli when the brotli module is
+    installed) compressed copies that a front end can serve as they are.
+
+    The files of each project are kept in a manifest, so that the files synced by a run are merged with the ones of
+    the previous runs. A page is only written again when its content changes, and the root index only when a project
+    is added.
     """
 
     package_begin = """<!DOCTYPE html>
@@ -22,46 +40,218 @@ class SimpleIndexGenerator:
 </html>
 """
 
-    def __init__(self, simple_root):
+    root_begin = """<!DOCTYPE html>
+<html>
+  <head>
+    <title>Simple index</title>
+  </head>
+  <body>
+"""
+
+    root_link = '    <a href="{package_name}/">{package_name}</a><br/>\n'
+
+    root_end = package_end
+
+    api_version = "1.1"
+
+    # The index files of a page: index.html and index.json
+    formats = ("html", "json")
+
+    def __init__(self, simple_root, manifest_file=None):
+        """
+        :param simple_root: the folder of the index
+        :param manifest_file: the sqlite database of the indexed files. None to only index the packages given to
+                              generate()
+        """
         self._simple_root = simple_root
+        if manifest_file is None:
+            manifest_file = ":memory:"
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+        self._db = sqlite3.connect(manifest_file)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "project TEXT, "
+                "basename TEXT, "
+                "link TEXT, "
+                "sha256 TEXT, "
+                "PRIMARY KEY (project, basename)"
+                ")"
+            )
+            # Columns added along with the JSON pages
+            columns = set(row[1] for row in self._db.execute("PRAGMA table_info(files)"))
+            for column in ("version", "size", "yanked"):
+                if column not in columns:
+                    self._db.execute("ALTER TABLE files ADD COLUMN %s TEXT" % column)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "project TEXT PRIMARY KEY, "
+                "content_hash TEXT"
+                ")"
+            )
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def _write_atomic(filename, content):
+        """
+        Write a file through a temporary file, so that the index is never seen half written
+        """
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, "wb") as fp:
+            fp.write(content)
+        os.replace(tmp_filename, filename)
+
+    def render_project(self, package_name, files):
+        """
+        :param files: the (basename, link, sha256, version, size, yanked) of the project files, sorted by basename
+        :return: the content of the project page, by format
+        """
+        html = [self.package_begin.format(package_name=package_name)]
+        for basename, link, file_hash, _, _, _ in files:
+            html.append(self.package_link.format(link=link, basename=basename, hash=file_hash))
+        html.append(self.package_end)
+
+        # api-version 1.1 (PEP 700) requires the size of every file, else the page is a 1.0 one
+        sized = all(size is not None for _, _, _, _, size, _ in files)
+        data = {
+            "meta": {"api-version": self.api_version if sized else "1.0"},
+            "name": package_name,
+            "files": [],
+        }
+        if sized:
+            versions = set(version for _, _, _, version, _, _ in files if version is not None)
+            data["versions"] = sorted(versions, key=self._version_key)
+        for basename, link, file_hash, _, size, yanked in files:
+            entry = {
+                "filename": basename,
+                "url": link,
+                "hashes": {"sha256": file_hash},
+                "yanked": json.loads(yanked) if yanked else False,
+            }
+            if sized:
+                entry["size"] = int(size)
+            data["files"].append(entry)
+        return {
+            "html": "".join(html).encode(),
+            "json": json.dumps(data, sort_keys=True, separators=(",", ":")).encode(),
+        }
+
+    def _render_root(self, packages_names):
+        """
+        :return: the content of the root page, by format
+        """
+        html = [self.root_begin]
+        for package_name in packages_names:
+            html.append(self.root_link.format(package_name=package_name))
+        html.append(self.root_end)
+        data = {
+            "meta": {"api-version": self.api_version},
+            "projects": [{"name": package_name} for package_name in packages_names],
+        }
+        return {
+            "html": "".join(html).encode(),
+            "json": json.dumps(data, sort_keys=True, separators=(",", ":")).encode(),
+        }
+
+    @staticmethod
+    def _version_key(version):
+        try:
+            return 0, packaging.version.Version(version), version
+        except packaging.version.InvalidVersion:
+            return 1, None, version
+
+    @staticmethod
+    def _gzip(content):
+        """
+        :return: content compressed with gzip. mtime is fixed so that the same content always gives the same file
+        """
+        output = io.BytesIO()
+        with gzip.GzipFile(fileobj=output, mode="wb", compresslevel=9, mtime=0) as fp:
+            fp.write(content)
+        return output.getvalue()
+
+    def _write_page(self, folder, contents):
+        """
+        Write the index files of a page, and their compressed copies
+        :param contents: the content of the page, by format
+        """
+        for page_format, content in contents.items():
+            filename = os.path.join(folder, "index.%s" % page_format)
+            self._write_atomic(filename, content)
+            self._write_atomic(filename + ".gz", self._gzip(content))
+            if brotli is not None:
+                self._write_atomic(filename + ".br", brotli.compress(content))
+
+    def _page_exists(self, folder):
+        return all(
+            os.path.exists(os.path.join(folder, "index.%s" % page_format))
+            for page_format in self.formats
+        )
+
+    def _update_page(self, package_name):
+        """
+        Write the page of a project if its content changed
+        :return: True if the page was written
+        """
+        package_root = os.path.join(self._simple_root, package_name)
+        files = self._db.execute(
+            "SELECT basename, link, sha256, version, size, yanked FROM files WHERE project = ? ORDER BY basename",
+            (package_name,)
+        ).fetchall()
+        contents = self.render_project(package_name, files)
+        content_hash = hashlib.sha256(b"".join(contents[x] for x in self.formats)).hexdigest()
+        row = self._db.execute("SELECT content_hash FROM pages WHERE project = ?", (package_name,)).fetchone()
+        if row is not None and row[0] == content_hash and self._page_exists(package_root):
+            return False
+        self._write_page(package_root, contents)
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages (project, content_hash) VALUES (?, ?)",
+                (package_name, content_hash)
+            )
+        return True
 
     def generate(self, packages):
         """
-        Generates an index for each package
+        Add packages to the index, and update the pages of their projects
         :param packages: the list of packages
+        :return: the number of pages written
         """
-
-        # Begin with grouping packages by normalized names
-        grouped = {}
-        for package in packages:
-            package_name = pypi_simple.normalize(package.name)
-            if package_name not in grouped:
-                grouped[package_name] = {
-                    "package_root": os.path.join(self._simple_root, package_name),
-                    "links": [],
-                    "basenames": [],
-                    "file_hashes": []
-                }
-            link = os.path.relpath(package.local_file, grouped[package_name]["package_root"])
-            grouped[package_name]["links"].append(link)
-            grouped[package_name]["basenames"].append(os.path.basename(package.local_file))
-            grouped[package_name]["file_hashes"].append(os.path.basename(package.file_hash))
-
-        for package_name in grouped:
-            os.makedirs(grouped[package_name]["package_root"], exist_ok=True)
-            with open(os.path.join(grouped[package_name]["package_root"], "index.html"), "wt") as index_html:
-                index_html.write(self.package_begin.format(package_name=package_name))
-                # Packages are sorted by basename
-                for link, basename, file_hash in sorted(zip(
-                        grouped[package_name]["links"],
-                        grouped[package_name]["basenames"],
-                        grouped[package_name]["file_hashes"]
-                ), key=lambda x: x[1]):
-                    index_html.write(
-                        self.package_link.format(
-                            link=link,
-                            basename=basename,
-                            hash=file_hash
-                        )
+        known = set(row[0] for row in self._db.execute("SELECT project FROM pages"))
+        touched = set()
+        with self._db:
+            for package in packages:
+                package_name = pypi_simple.normalize(package.name)
+                package_root = os.path.join(self._simple_root, package_name)
+                size = package.size
+                if size is None and os.path.exists(package.local_file):
+                    size = os.path.getsize(package.local_file)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files (project, basename, link, sha256, version, size, yanked) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        package_name,
+                        os.path.basename(package.local_file),
+                        os.path.relpath(package.local_file, package_root),
+                        package.file_hash,
+                        package.version,
+                        size,
+                        json.dumps(package.yanked) if package.yanked else None
                     )
-                index_html.write(self.package_end)
+                )
+                touched.add(package_name)
+
+        written = 0
+        for package_name in sorted(touched):
+            if self._update_page(package_name):
+                written += 1
+
+        if not touched.issubset(known) or not self._page_exists(self._simple_root):
+            packages_names = [row[0] for row in self._db.execute("SELECT project FROM pages ORDER BY project")]
+            self._write_page(self._simple_root, self._render_root(packages_names))
+            written += 1
+        return written
@@ -0,0 +1,152 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class SyncMetrics:
+    """
+    Timings and throughput of a sync run, by stage.
+
+    Durations and rates are kept as histograms (count, sum, min, max and cumulative buckets, as in Prometheus), totals
+    as counters. The metrics of the running sync are shared through current(), so that any part of the code can
+    record them. The report is written as JSON, and optionally in the Prometheus textfile format.
+    """
+
+    # seconds
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    # bytes per second
+    rate_buckets = (1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9)
+
+    prometheus_prefix = "pypisync_"
+
+    _current = None
+    _current_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._start = time.time()
+
+    @classmethod
+    def set_current(cls, metrics):
+        """
+        Set the metrics recorded by the whole process
+        :param metrics: a SyncMetrics
+        """
+        with cls._current_lock:
+            cls._current = metrics
+
+    @classmethod
+    def current(cls):
+        with cls._current_lock:
+            if cls._current is None:
+                cls._current = cls()
+            return cls._current
+
+    def observe(self, name, value, buckets=None):
+        """
+        Add a value to a histogram
+        :param name: the histogram name
+        :param value: the value
+        :param buckets: the upper bounds of the buckets, used when the histogram is created. Defaults to seconds
+        """
+        with self._lock:
+            if name not in self._histograms:
+                bounds = buckets or self.default_buckets
+                self._histograms[name] = {
+                    "count": 0,
+                    "sum": 0.0,
+                    "min": None,
+                    "max": None,
+                    "buckets": dict((bound, 0) for bound in bounds),
+                }
+            histogram = self._histograms[name]
+            histogram["count"] += 1
+            histogram["sum"] += value
+            if histogram["min"] is None or value < histogram["min"]:
+                histogram["min"] = value
+            if histogram["max"] is None or value > histogram["max"]:
+                histogram["max"] = value
+            for bound in histogram["buckets"]:
+                if value <= bound:
+                    histogram["buckets"][bound] += 1
+
+    def increment(self, name, value=1):
+        """
+        Add value to a counter
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Record the duration of the block in the "<name>_seconds" histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("%s_seconds" % name, time.perf_counter() - start)
+
+    def report(self):
+        """
+        :return: the metrics, as a JSON serializable dict
+        """
+        with self._lock:
+            histograms = {}
+            for name, histogram in self._histograms.items():
+                histograms[name] = dict(histogram)
+                histograms[name]["mean"] = histogram["sum"] / histogram["count"] if histogram["count"] else None
+                histograms[name]["buckets"] = dict(
+                    (repr(float(bound)), count)
+                    for bound, count in histogram["buckets"].items()
+                )
+            return {
+                "start": self._start,
+                "duration": time.time() - self._start,
+                "counters": dict(self._counters),
+                "histograms": histograms,
+            }
+
+    def prometheus(self):
+        """
+        :return: the metrics in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                metric = "%s%s_total" % (self.prometheus_prefix, name)
+                lines.append("# TYPE %s counter" % metric)
+                lines.append("%s %s" % (metric, self._counters[name]))
+            for name in sorted(self._histograms):
+                histogram = self._histograms[name]
+                metric = "%s%s" % (self.prometheus_prefix, name)
+                lines.append("# TYPE %s histogram" % metric)
+                # In increasing order, as dicts are not ordered before Python 3.6
+                for bound, count in sorted(histogram["buckets"].items()):
+                    lines.append('%s_bucket{le="%s"} %d' % (metric, repr(float(bound)), count))
+                lines.append('%s_bucket{le="+Inf"} %d' % (metric, histogram["count"]))
+                lines.append("%s_sum %s" % (metric, repr(histogram["sum"])))
+                lines.append("%s_count %d" % (metric, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write_atomic(filename, content):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wt") as fp:
+            fp.write(content)
+        os.replace(tmp_filename, filename)
+
+    def write_json(self, filename):
+        self._write_atomic(filename, json.dumps(self.report(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, filename):
+        """
+        Write the metrics for the node_exporter textfile collector
+        """
+        self._write_atomic(filename, self.prometheus())
@@ -0,0 +1,124 @@
+import json
+import os
+import pypi_simple
+
+import pypisync
+
+
+class SyncPlan:
+    """
+    The full closure of files of a sync, written as JSON lines so that the fetch can be run (again) separately.
+    Each file is stored with the (normalized name, version) of the packages it depends on.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def add(self, package, dependencies=()):
+        """
+        :param package: a PypiPackage
+        :param dependencies: the PypiPackage it depends on
+        """
+        if package not in self._entries:
+            self._entries[package] = set()
+        for dependency in dependencies:
+            self._entries[package].add((pypi_simple.normalize(dependency.name), dependency.version))
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, package):
+        return package in self._entries
+
+    orders = ("plan", "smallest_first", "largest_first")
+
+    def ordered(self, order="plan"):
+        """
+        :param order: "plan" for the resolution order, "smallest_first" or "largest_first" by the sizes given by
+                      upstream. The files of unknown size come last
+        :return: the packages in the order they are fetched
+        """
+        if order not in self.orders:
+            raise ValueError("Unknown order %r, expected one of %s" % (order, ", ".join(self.orders)))
+        packages = list(self._entries)
+        if order == "smallest_first":
+            packages.sort(key=lambda package: (package.size is None, package.size or 0))
+        elif order == "largest_first":
+            packages.sort(key=lambda package: (package.size is None, -(package.size or 0)))
+        return packages
+
+    @property
+    def total_size(self):
+        """
+        :return: the sum of the known file sizes
+        """
+        return sum(package.size for package in self._entries if package.size is not None)
+
+    @property
+    def unknown_sizes(self):
+        """
+        :return: the number of files whose size is not known
+        """
+        return len([package for package in self._entries if package.size is None])
+
+    def simplified_dependencies(self):
+        """
+        :return: the dependency graph between (normalized name, version) packages
+        """
+        result = {}
+        for package, dependencies in self._entries.items():
+            simplified = pypisync.PypiPackage(pypi_simple.normalize(package.name), package.version)
+            if simplified not in result:
+                result[simplified] = set()
+            for name, version in dependencies:
+                result[simplified].add(pypisync.PypiPackage(name, version))
+        return result
+
+    def write(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wt") as fp:
+            for package in sorted(self._entries):
+                fp.write(json.dumps(
+                    {
+                        "name": package.name,
+                        "version": package.version,
+                        "filename": package.file_basename,
+                        "url": package.url,
+                        "sha256": package.file_hash,
+                        "size": package.size,
+                        "yanked": package.yanked,
+                        "dependencies": sorted(self._entries[package]),
+                    },
+                    separators=(",", ":")
+                ))
+                fp.write("\n")
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def read(cls, filename, destination_folder, simple_layout, environment):
+        """
+        Read a plan written by write()
+        :return: a SyncPlan whose packages are stored in destination_folder
+        """
+        plan = cls()
+        with open(filename, "rt") as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                package = pypisync.PypiPackage(
+                    entry["name"],
+                    entry["version"],
+                    entry["url"],
+                    destination_folder,
+                    simple_layout,
+                    environment,
+                    size=entry["size"],
+                    yanked=entry.get("yanked", False)
+                )
+                plan._entries[package] = set(tuple(x) for x in entry["dependencies"])
+        return plan
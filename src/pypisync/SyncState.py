@@ -0,0 +1,82 @@
+import hashlib
+import json
+import logging
+import os
+import pypi_simple
+
+
+class SyncState:
+    """
+    What is remembered between two runs to allow incremental syncs:
+      * the last upstream changelog serial that was fully processed
+      * a fingerprint of the configuration it was processed with
+      * the projects that pulled each dependency project
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, filename):
+        self._filename = filename
+        self.serial = None
+        self.config_fingerprint = None
+        self._reverse_dependencies = {}
+        if os.path.exists(self._filename):
+            with open(self._filename, "rt") as fp:
+                data = json.load(fp)
+            self.serial = data.get("serial")
+            self.config_fingerprint = data.get("config_fingerprint")
+            self._reverse_dependencies = {
+                dependency: set(dependents)
+                for dependency, dependents in data.get("reverse_dependencies", {}).items()
+            }
+
+    @staticmethod
+    def fingerprint(config):
+        """
+        :param config: the parts of the configuration that change what is synced
+        :return: a stable hash of config
+        """
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def add_dependency(self, project, dependency):
+        """
+        Record that project depends on dependency
+        """
+        dependency = pypi_simple.normalize(dependency)
+        if dependency not in self._reverse_dependencies:
+            self._reverse_dependencies[dependency] = set()
+        self._reverse_dependencies[dependency].add(project)
+
+    def affected(self, changed):
+        """
+        :param changed: names of projects that changed upstream
+        :return: the names of the changed projects and of all the projects depending on them, directly or not
+        """
+        result = set(changed)
+        visited = set()
+        to_visit = list(changed)
+        while to_visit:
+            name = pypi_simple.normalize(to_visit.pop())
+            if name in visited:
+                continue
+            visited.add(name)
+            for dependent in self._reverse_dependencies.get(name, ()):
+                result.add(dependent)
+                to_visit.append(dependent)
+        return result
+
+    def save(self):
+        os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+        tmp_filename = self._filename + ".tmp"
+        with open(tmp_filename, "wt") as fp:
+            json.dump(
+                {
+                    "serial": self.serial,
+                    "config_fingerprint": self.config_fingerprint,
+                    "reverse_dependencies": {
+                        dependency: sorted(dependents)
+                        for dependency, dependents in self._reverse_dependencies.items()
+                    }
+                },
+                fp
+            )
+        os.replace(tmp_filename, self._filename)
@@ -1,46 +1,88 @@
+import base64
 import xmlrpc.client
 import http.client
-import os
 import logging
+import urllib.parse
+import urllib.request
 
 
 logger = logging.getLogger(__name__)
 
 
 class ProxiedTransport(xmlrpc.client.SafeTransport):
+    """
+    XML-RPC transport keeping its connection alive between the calls, directly or through a http proxy.
+    The https endpoints are reached through the proxy with a CONNECT tunnel, the http ones with absolute URIs.
+    """
     def __init__(self, use_datetime=False, use_builtin_types=False,
-                 *, headers=(), proxy=None):
+                 *, headers=(), proxy=None, https=True, context=None):
         try:
             super().__init__(use_datetime=use_datetime,
                              use_builtin_types=use_builtin_types,
-                             headers=headers)
+                             headers=headers,
+                             context=context)
         except TypeError:
             # Backward compatibility for older python
             super().__init__(use_datetime=use_datetime,
-                             use_builtin_types=use_builtin_types)
-        self.proxy = proxy
-        if self.proxy is not None:
-            while self.proxy.endswith("/"):
-                self.proxy = self.proxy[:-1]
-            while self.proxy.startswith("http://"):
-                self.proxy = self.proxy[7:]
-            while self.proxy.startswith("https://"):
-                self.proxy = self.proxy[8:]
-        self.real_host = None
+                             use_builtin_types=use_builtin_types,
+                             context=context)
+        self.proxy = None
+        self.proxy_headers = {}
+        self.https = https
+        if proxy is not None:
+            if "://" not in proxy:
+                proxy = "http://%s" % proxy
+            parsed = urllib.parse.urlparse(proxy)
+            self.proxy = parsed.hostname
+            if parsed.port is not None:
+                self.proxy = "%s:%d" % (self.proxy, parsed.port)
+            if parsed.username is not None:
+                credentials = "%s:%s" % (
+                    urllib.parse.unquote(parsed.username),
+                    urllib.parse.unquote(parsed.password or "")
+                )
+                self.proxy_headers["Proxy-Authorization"] = "Basic %s" % base64.b64encode(credentials.encode()).decode()
 
     def make_connection(self, host):
         if self.proxy is None:
+            if not self.https:
+                # Plain http endpoint, a local mirror for example
+                return xmlrpc.client.Transport.make_connection(self, host)
             return super().make_connection(host)
-        self.real_host = host
-        h = http.client.HTTPConnection(self.proxy)
-        return h
+        # Kept alive between the calls, as the base transports do
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        if self.https:
+            connection = http.client.HTTPSConnection(self.proxy, None, context=self.context, **(x509 or {}))
+            connection.set_tunnel(chost, headers=self.proxy_headers)
+        else:
+            connection = http.client.HTTPConnection(self.proxy)
+            self._extra_headers = list(self._extra_headers or []) + list(self.proxy_headers.items())
+        self._connection = host, connection
+        return connection
 
     def send_request(self, host, handler, request_body, debug):
-        if self.proxy is not None:
-            handler = 'http://%s%s' % (self.real_host, handler)
+        if self.proxy is not None and not self.https:
+            handler = 'http://%s%s' % (host, handler)
         return super().send_request(host, handler, request_body, debug)
 
 
+def get_proxy(uri):
+    """
+    :return: the proxy of uri from the environment (HTTPS_PROXY, HTTP_PROXY, NO_PROXY), None for a direct connection
+    """
+    parsed = urllib.parse.urlparse(uri)
+    proxies = urllib.request.getproxies()
+    proxy = proxies.get(parsed.scheme)
+    if proxy is None and parsed.scheme == "https":
+        # HTTP_PROXY used to be the only one looked at
+        proxy = proxies.get("http")
+    if proxy is not None and parsed.hostname and urllib.request.proxy_bypass(parsed.hostname):
+        return None
+    return proxy
+
+
 def get_xmlrpc_server_proxy(
         uri,
         transport=None,
@@ -56,10 +98,12 @@ def get_xmlrpc_server_proxy(
     if transport is not None:
         logger.error("transport is ignored as it is replaced by ProxiedTransport")
     p = ProxiedTransport(
-        proxy=os.environ.get("HTTP_PROXY", None),
-        use_datetime=False,
-        use_builtin_types=False,
-        headers=(),
+        proxy=get_proxy(uri),
+        use_datetime=use_datetime,
+        use_builtin_types=use_builtin_types,
+        headers=headers,
+        https=urllib.parse.urlparse(uri).scheme != "http",
+        context=context,
     )
     try:
         return xmlrpc.client.ServerProxy(
@@ -3,14 +3,52 @@
 
 __version__ = "1.0.0"
 
-from .PypiSync import PypiSync
+from .PypiSync import PypiSync, PypiConnector, LightPackage
 from .PypiPackage import PypiPackage
 from .XmlRPC import ServerProxy
 from .SimpleIndexGenerator import SimpleIndexGenerator
+from .DownloadScheduler import DownloadScheduler
+from .HttpDownloader import HttpDownloader, HashMismatchError
+from .ProjectInfoCache import ProjectInfoCache
+from .SyncState import SyncState
+from .RemoteMetadata import RemoteMetadata
+from .SyncPlan import SyncPlan
+from .ProjectVersions import ProjectVersions
+from .EnvironmentMarker import EnvironmentMarker
+from .ProjectNameFilter import ProjectNameFilter
+from .ProjectInfoFetcher import ProjectInfoFetcher
+from .BlobStore import BlobStore
+from .FileIndex import FileIndex
+from .SyncMetrics import SyncMetrics
+from .ProjectInfoParser import ProjectInfoParser
+from .RequestPolicy import RequestPolicy, RetryableError
+from .DependencyStore import DependencyStore
+from .CachingProxy import CachingProxy
+from .ShardCoordinator import ShardCoordinator
+from .BandwidthLimiter import BandwidthLimiter
 
 USER_AGENT = "pypisync {version}".format(version=__version__)
 
 
-def main(config_file, simple_layout, gen_graph):
-    syncer = PypiSync(config_file, simple_layout, gen_graph)
+def main(
+        config_file,
+        simple_layout,
+        gen_graph,
+        verify=False,
+        full=False,
+        dry_run=False,
+        plan_file=None,
+        fetch_only=False,
+        shard=None,
+        merge_shards=False
+):
+    syncer = PypiSync(config_file, simple_layout, gen_graph, verify, full, dry_run, plan_file, fetch_only, shard)
+    if merge_shards:
+        return syncer.merge_shards()
     return syncer.run()
+
+
+def serve(config_file, host, port):
+    # The files are always stored with the simple layout, as served
+    syncer = PypiSync(config_file, True, False)
+    return syncer.serve(host, port)
@@ -9,9 +9,50 @@ import logging
 def create_parser():
     parser = argparse.ArgumentParser()
 
+    parser.add_argument(
+        "command",
+        help="sync: mirror the configured packages. serve: serve the destination folder as a pull-through cache",
+        nargs="?",
+        choices=["sync", "serve"],
+        default="sync"
+    )
+
     parser.add_argument("-c", "--config", help="Path to the configuration file", default="./pypisync.conf")
     parser.add_argument("-d", "--debug", help="Activate debug", action="store_true", default=False)
     parser.add_argument("-g", "--gen_graph", help="Generate a dependency graph", action="store_true", default=False)
+    parser.add_argument(
+        "--verify",
+        help="Check the sha256 of the files of the destination folder without asking upstream, and download the "
+             "corrupted and missing files of the last plan again",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "-f",
+        "--full",
+        help="Examine all the packages again instead of the ones that changed since the previous sync",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        help="Only resolve the files to sync, write the plan and report its size",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "-p",
+        "--plan",
+        help="Path to the plan file. Defaults to destination_folder/.pypisync/plan.jsonl",
+        default=None
+    )
+    parser.add_argument(
+        "--fetch-only",
+        help="Do not resolve anything, only fetch the files of an existing plan",
+        action="store_true",
+        default=False
+    )
     parser.add_argument(
         "-s",
         "--simple_layout",
@@ -19,6 +60,20 @@ def create_parser():
         action="store_true",
         default=False
     )
+    parser.add_argument(
+        "--shard",
+        help="Only sync the i-th of N shards of the projects (i/N, from 0/N), handing the other dependencies to the "
+             "nodes syncing the other shards",
+        default=None
+    )
+    parser.add_argument(
+        "--merge-shards",
+        help="Build the simple index of all the shards, once all their nodes are done",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument("--bind", help="Address to listen on when serving", default="127.0.0.1")
+    parser.add_argument("--port", help="Port to listen on when serving", type=int, default=8080)
 
     return parser
 
@@ -29,7 +84,22 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
-    sys.exit(pypisync.main(opts.config, opts.simple_layout, opts.gen_graph))
+    if opts.command == "serve":
+        sys.exit(pypisync.serve(opts.config, opts.bind, opts.port))
+    sys.exit(
+        pypisync.main(
+            opts.config,
+            opts.simple_layout,
+            opts.gen_graph,
+            opts.verify,
+            opts.full,
+            opts.dry_run,
+            opts.plan,
+            opts.fetch_only,
+            opts.shard,
+            opts.merge_shards
+        )
+    )
 
 
 if __name__ == "__main__":
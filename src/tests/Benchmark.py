@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+End to end benchmark of pypisync against a synthetic PyPI served on localhost.
+
+    cd src && python -m tests.Benchmark --projects 200 --files 5 --fan-out 3 --size 65536 --latency 0.01
+
+Three syncs are timed: a cold one, one where nothing changed upstream, and one after an upload to a project, which
+must download the uploaded file and nothing else.
+The wall time, the number of requests answered by the fake PyPI and the time spent in each stage (from the metrics of
+the run) are printed as JSON.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pypisync
+
+from .FakePypi import FakePypi
+
+
+class Benchmark:
+    """
+    Time PypiSync.run end to end and by stage against a FakePypi
+    """
+
+    def __init__(self, fake_pypi, simple_layout=True, download=None):
+        """
+        :param fake_pypi: a started FakePypi
+        :param simple_layout: sync with the simple layout
+        :param download: the "download" configuration
+        """
+        self._fake_pypi = fake_pypi
+        self._simple_layout = simple_layout
+        self._temp_dir = tempfile.mkdtemp(suffix="pypisync_benchmark")
+        self._metrics_file = os.path.join(self._temp_dir, "metrics.json")
+        self._config_file = os.path.join(self._temp_dir, "pypisync.conf")
+        with open(self._config_file, "wt") as fp:
+            json.dump(
+                {
+                    "endpoint": fake_pypi.url,
+                    "destination_folder": os.path.join(self._temp_dir, "data"),
+                    "arch_exclude": None,
+                    "environment": None,
+                    "packages_re": {".*": ["latest"]},
+                    "packages": {},
+                    "download": download,
+                    "metrics": {"file": self._metrics_file},
+                },
+                fp
+            )
+
+    @property
+    def destination_folder(self):
+        return os.path.join(self._temp_dir, "data")
+
+    def sync(self, full=False):
+        """
+        Run a sync
+        :return: the wall time, the number of requests and the time spent in each stage
+        """
+        requests_before = self._fake_pypi.requests
+        start = time.perf_counter()
+        result = pypisync.main(self._config_file, self._simple_layout, False, full=full)
+        wall = time.perf_counter() - start
+        if result != 0:
+            raise RuntimeError("The sync failed with %d" % result)
+        with open(self._metrics_file, "rt") as fp:
+            report = json.load(fp)
+        return {
+            "wall_seconds": wall,
+            "requests": self._fake_pypi.requests - requests_before,
+            "counters": report["counters"],
+            "stages": dict(
+                (name[:-len("_seconds")], histogram["sum"])
+                for name, histogram in sorted(report["histograms"].items())
+                if name.endswith("_seconds")
+            ),
+        }
+
+    def run(self):
+        """
+        :return: the results of the cold, unchanged and updated syncs
+        """
+        results = {"cold": self.sync()}
+        results["unchanged"] = self.sync()
+        uploaded = self._fake_pypi.touch(self._fake_pypi.names[0])
+        downloads_before = len(self._fake_pypi.downloads)
+        results["updated"] = self.sync()
+        downloaded = sorted(set(self._fake_pypi.downloads[downloads_before:]))
+        if downloaded != [uploaded]:
+            raise RuntimeError("The updated sync downloaded %s instead of %s" % (downloaded, uploaded))
+        return results
+
+    def close(self):
+        shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Benchmark pypisync against a local synthetic PyPI")
+    parser.add_argument("--projects", help="Number of projects", type=int, default=100)
+    parser.add_argument("--files", help="Number of files of each project", type=int, default=3)
+    parser.add_argument("--fan-out", help="Number of dependencies of each project", type=int, default=2)
+    parser.add_argument("--size", help="Size of the artifacts, in bytes", type=int, default=64 * 1024)
+    parser.add_argument("--latency", help="Delay of each response, in seconds", type=float, default=0.0)
+    parser.add_argument("--seed", help="Seed of the generated PyPI", type=int, default=0)
+    parser.add_argument("--workers", help="Number of parallel downloads", type=int, default=None)
+    parser.add_argument("--flat", help="Sync with the flat layout", action="store_true", default=False)
+    parser.add_argument("-d", "--debug", help="Activate debug", action="store_true", default=False)
+    return parser
+
+
+def main():
+    opts = create_parser().parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.DEBUG if opts.debug else logging.WARNING)
+    with FakePypi(opts.projects, opts.files, opts.fan_out, opts.size, opts.latency, opts.seed) as fake_pypi:
+        benchmark = Benchmark(fake_pypi, not opts.flat, {"workers": opts.workers})
+        try:
+            results = benchmark.run()
+        finally:
+            benchmark.close()
+    results["parameters"] = vars(opts)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+import hashlib
+import http.server
+import io
+import json
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+import xmlrpc.client
+import zipfile
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Same as http.server.ThreadingHTTPServer, which needs Python 3.7
+    """
+    daemon_threads = True
+
+
+class FakePypi:
+    """
+    Synthetic PyPI served on localhost, for the tests and the benchmarks.
+
+    It implements what pypisync uses:
+      * the XML-RPC API on /pypi/: list_packages, changelog_last_serial, changelog_since_serial, package_releases and
+        system.multicall
+      * the JSON API on /pypi/<project>/json, with ETag revalidation
+      * the artifacts on /files/<filename>, with their PEP 658 metadata on /files/<filename>.metadata
+
+    Project i depends on fan_out projects among the next ones, so that the dependency graph has no cycle. Every
+    response is delayed by latency seconds. The content only depends on the parameters and on seed.
+    """
+
+    def __init__(
+            self,
+            projects=10,
+            files_per_project=3,
+            fan_out=2,
+            artifact_size=1024,
+            latency=0.0,
+            seed=0,
+            multicall=True
+    ):
+        """
+        :param projects: the number of projects
+        :param files_per_project: the number of versions of each project, with one wheel each
+        :param fan_out: the number of dependencies of each project
+        :param artifact_size: the size of the content added to each wheel, in bytes
+        :param latency: the delay of each response, in seconds
+        :param seed: the seed of the random generator
+        :param multicall: False to answer system.multicall with a fault, as PyPI does
+        """
+        self.latency = latency
+        self.multicall = multicall
+        self.serial = 1
+        self.requests = 0
+        # The artifacts sent, in order
+        self.downloads = []
+        # The client (address, port) of each connection
+        self.connections = set()
+        self._requests_lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._artifact_size = artifact_size
+        self._dependencies = {}
+        self._names = ["project-%04d" % i for i in range(projects)]
+        self._artifacts = {}
+        self._projects = {}
+        for i, name in enumerate(self._names):
+            following = self._names[i + 1:]
+            self._dependencies[name] = self._random.sample(following, min(fan_out, len(following)))
+            self._projects[name] = self._generate_project(name, files_per_project)
+        self._server = None
+        self._thread = None
+        self.url = None
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    def _generate_file(self, name, version):
+        """
+        :return: the file of a version of the project, as in the JSON API
+        """
+        filename = "%s-%s-py3-none-any.whl" % (name.replace("-", "_"), version)
+        metadata = "Metadata-Version: 2.1\nName: %s\nVersion: %s\n" % (name, version)
+        for dependency in self._dependencies[name]:
+            metadata += "Requires-Dist: %s>=1.0\n" % dependency
+        metadata = metadata.encode()
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, "w", zipfile.ZIP_STORED) as wheel:
+            dist_info = "%s-%s.dist-info" % (name.replace("-", "_"), version)
+            wheel.writestr("%s/METADATA" % dist_info, metadata)
+            wheel.writestr("%s/WHEEL" % dist_info, "Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any\n")
+            wheel.writestr("%s/data.bin" % name, self._random.getrandbits(8 * self._artifact_size).to_bytes(
+                self._artifact_size, "little"
+            ) if self._artifact_size else b"")
+        content = content.getvalue()
+        self._artifacts[filename] = content
+        self._artifacts[filename + ".metadata"] = metadata
+        return {
+            "filename": filename,
+            "url": "/files/%s" % filename,
+            "digests": {"sha256": hashlib.sha256(content).hexdigest()},
+            "size": len(content),
+            "yanked": False,
+            "yanked_reason": None,
+            "core-metadata": {"sha256": hashlib.sha256(metadata).hexdigest()},
+        }
+
+    def _generate_project(self, name, files_per_project):
+        """
+        :return: the releases of the project, as in the JSON API
+        """
+        releases = {}
+        for i in range(files_per_project):
+            version = "1.%d" % i
+            releases[version] = [self._generate_file(name, version)]
+        return {"info": {"name": name, "version": "1.%d" % (files_per_project - 1)}, "releases": releases}
+
+    def touch(self, name):
+        """
+        Simulate an upload to a project: a new version with one file is released, its ETag changes and it appears in
+        the changelog
+        :return: the filename of the new file
+        """
+        project = self._projects[name]
+        version = "1.%d" % len(project["releases"])
+        release = self._generate_file(name, version)
+        project["releases"][version] = [release]
+        project["info"]["version"] = version
+        self.serial += 1
+        project["last_serial"] = self.serial
+        return release["filename"]
+
+    def _count_request(self, client_address):
+        with self._requests_lock:
+            self.requests += 1
+            self.connections.add(client_address)
+
+    def _xmlrpc(self, method, params):
+        if method == "list_packages":
+            return self.names
+        if method == "changelog_last_serial":
+            return self.serial
+        if method == "changelog_since_serial":
+            return [
+                [name, project["info"]["version"], 0, "new release", project["last_serial"]]
+                for name, project in self._projects.items()
+                if project.get("last_serial", 1) > params[0]
+            ]
+        if method == "package_releases":
+            if params[0] not in self._projects:
+                raise xmlrpc.client.Fault(1, "Unknown project %s" % params[0])
+            return sorted(self._projects[params[0]]["releases"])
+        if method == "system.multicall" and self.multicall:
+            results = []
+            for call in params[0]:
+                try:
+                    results.append([self._xmlrpc(call["methodName"], call["params"])])
+                except xmlrpc.client.Fault as fault:
+                    results.append({"faultCode": fault.faultCode, "faultString": fault.faultString})
+            return results
+        raise xmlrpc.client.Fault(1, "Unknown method %s" % method)
+
+    def _handler(self):
+        fake_pypi = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, content=b"", content_type="application/octet-stream", headers=()):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(content)
+
+            def do_POST(self):
+                fake_pypi._count_request(self.client_address)
+                time.sleep(fake_pypi.latency)
+                params, method = xmlrpc.client.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                try:
+                    response = xmlrpc.client.dumps((fake_pypi._xmlrpc(method, params),), methodresponse=True)
+                except xmlrpc.client.Fault as fault:
+                    response = xmlrpc.client.dumps(fault, methodresponse=True)
+                self._send(200, response.encode(), "text/xml")
+
+            def do_GET(self):
+                fake_pypi._count_request(self.client_address)
+                time.sleep(fake_pypi.latency)
+                path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+                tokens = [x for x in path.split("/") if x]
+                if len(tokens) == 3 and tokens[0] == "pypi" and tokens[2] == "json":
+                    project = fake_pypi._projects.get(tokens[1])
+                    if project is None:
+                        self._send(404)
+                        return
+                    etag = '"%s-%d"' % (tokens[1], project.get("last_serial", 1))
+                    if self.headers.get("If-None-Match") == etag:
+                        self._send(304, headers=[("ETag", etag)])
+                        return
+                    self._send(200, json.dumps(project).encode(), "application/json", [("ETag", etag)])
+                elif len(tokens) == 2 and tokens[0] == "files" and tokens[1] in fake_pypi._artifacts:
+                    if self.command == "GET" and not tokens[1].endswith(".metadata"):
+                        with fake_pypi._requests_lock:
+                            fake_pypi.downloads.append(tokens[1])
+                    self._send(200, fake_pypi._artifacts[tokens[1]])
+                else:
+                    self._send(404)
+
+            do_HEAD = do_GET
+
+        return Handler
+
+    def start(self):
+        self._server = _Server(("localhost", 0), self._handler())
+        self.url = "http://localhost:%d/" % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -1,2 +1,25 @@
 from .PypiSyncTests import PypiSyncTests
+from .PypiSyncTests import BenchmarkTests
+from .PypiSyncTests import XmlRPCTests
+from .PypiSyncTests import ShardCoordinatorTests
+from .PypiSyncTests import CachingProxyTests
 from .PypiSyncTests import PypiUnitTests
+from .PypiSyncTests import DownloadSchedulerTests
+from .PypiSyncTests import BandwidthLimiterTests
+from .PypiSyncTests import RequestPolicyTests
+from .PypiSyncTests import HttpDownloaderTests
+from .PypiSyncTests import BlobStoreTests
+from .PypiSyncTests import FileIndexTests
+from .PypiSyncTests import VerifyTests
+from .PypiSyncTests import DependencyStoreTests
+from .PypiSyncTests import ProjectInfoCacheTests
+from .PypiSyncTests import SyncStateTests
+from .PypiSyncTests import RemoteMetadataTests
+from .PypiSyncTests import SyncPlanTests
+from .PypiSyncTests import ProjectVersionsTests
+from .PypiSyncTests import EnvironmentMarkerTests
+from .PypiSyncTests import ProjectNameFilterTests
+from .PypiSyncTests import ProjectInfoFetcherTests
+from .PypiSyncTests import ProjectInfoParserTests
+from .PypiSyncTests import SyncMetricsTests
+from .PypiSyncTests import SimpleIndexGeneratorTests